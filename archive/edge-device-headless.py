@@ -12,9 +12,13 @@ This headless version removes the local video display to optimize performance.
 Requirements:
 - Python 3.8+
 - ultralytics package (pip install ultralytics)
+- OpenVINO (optional, pip install openvino) for the INT8 model, or onnxruntime as a fallback
+- TensorRT (optional, for the exported .engine model on CUDA devices)
 - boto3 (pip install boto3)
 - AWSIoTPythonSDK (pip install AWSIoTPythonSDK)
 - opencv-python (pip install opencv-python)
+- orjson (pip install orjson)
+- PyGObject with GStreamer bindings (apt install python3-gi gir1.2-gstreamer-1.0)
 - Amazon Kinesis Video Streams Producer SDK (requires separate installation)
 
 Before running, configure AWS credentials and update the CONFIG section.
@@ -30,18 +34,33 @@ Usage:
 import os
 import sys
 import time
-import json
 import threading
 import queue
-import cv2
-import numpy as np
-import boto3
 import subprocess
+import selectors
 import argparse
 import traceback
+from collections import deque
 from datetime import datetime
+
+# OpenMP sizes its thread pool from OMP_NUM_THREADS when numpy and torch load, so this
+# has to be set before they are imported: YOLO gets all but two cores (KVS producer, capture/MQTT)
+os.environ.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) - 2)))
+
+import orjson
+import cv2
+import numpy as np
+import torch
+import boto3
 from ultralytics import YOLO
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient, DROP_OLDEST
+
+try:
+    import gi
+    gi.require_version("Gst", "1.0")
+    from gi.repository import Gst
+except (ImportError, ValueError):
+    Gst = None  # KVS falls back to the separate producer processes
 
 # ==================== CONFIG ====================
 # AWS Configuration
@@ -60,12 +79,26 @@ FRAME_WIDTH = 1280
 FRAME_HEIGHT = 720
 FPS = 15
 KVS_PRODUCER_PATH = "/mnt/c/code/ADRVE/adrve-edge/amazon-kinesis-video-streams-producer-sdk-cpp/build"
+# H.264 decoders for the YOLO branch, first installed one wins: (element, decode chain up to raw video)
+H264_DECODERS = [
+    ("nvv4l2decoder", "nvv4l2decoder ! nvvidconv ! video/x-raw,format=BGRx"),  # Jetson NVDEC
+    ("nvh264dec", "nvh264dec"),                                                # Desktop NVIDIA NVDEC
+    ("vaapih264dec", "vaapih264dec ! vaapipostproc"),                          # Intel VAAPI
+    ("v4l2h264dec", "v4l2h264dec"),                                            # Raspberry Pi / V4L2
+    ("avdec_h264", "avdec_h264"),                                              # Software decode
+]
 
 # YOLO Configuration
 YOLO_MODEL_PATH = "yolo11n.pt"  # Will be downloaded if not present
+YOLO_INPUT_SIZE = 640  # Frames are resized to this square model input
+YOLO_QUEUE_BUFFERS = 30  # Encoded buffers held for the YOLO decoder before the oldest are dropped (decoding recovers at the next keyframe)
+# Export names carry their settings, as other scripts export the same weights with different shapes
+YOLO_OPENVINO_PATH = f"yolo11n_{YOLO_INPUT_SIZE}_nms_int8_openvino_model"  # OpenVINO INT8 export of YOLO_MODEL_PATH, created on first run
+YOLO_ONNX_PATH = f"yolo11n_{YOLO_INPUT_SIZE}_nms.onnx"  # ONNX Runtime fallback if the OpenVINO export is unavailable
+YOLO_ENGINE_PATH = f"yolo11n_{YOLO_INPUT_SIZE}_nms.engine"  # TensorRT FP16 engine, preferred over OpenVINO on CUDA devices
 CONFIDENCE_THRESHOLD = 0.3
 # Classes we're particularly interested in (subset of COCO)
-CLASSES_OF_INTEREST = [
+CLASSES_OF_INTEREST = frozenset({
     0,   # person
     1,   # bicycle
     2,   # car
@@ -76,23 +109,42 @@ CLASSES_OF_INTEREST = [
     16,  # dog
     17,  # cat
     18,  # horse
-]
+})
+# Indexed by COCO class id, for filtering all boxes of a frame at once
+CLS_MASK = np.zeros(80, dtype=bool)
+CLS_MASK[list(CLASSES_OF_INTEREST)] = True
 
 # Performance Configuration
 YOLO_PROCESSING_INTERVAL = 0.2  # Process frames every 0.2 seconds (5 FPS for YOLO)
 MQTT_PUBLISH_INTERVAL = 1.0     # Publish detections every 1 second
+MOTION_SIZE = 32                # Frames are compared at 32x32 to gate YOLO
+MOTION_THRESHOLD = 2.0          # Mean absolute difference below which a frame counts as unchanged
+MOTION_MAX_SKIP = 2.0           # Run YOLO at least every 2 seconds even in a static scene
+STATS_LOG_INTERVAL = 30.0       # Log queue depth, drops and latency every 30 seconds
+MQTT_KEEPALIVE_INTERVAL = 10.0  # Republish unchanged detections at most every 10 seconds
+MQTT_OFFLINE_QUEUE_SIZE = 10    # Only the newest detections are worth sending after a reconnect
+
+# CPU Configuration: core 0 for the KVS producer, the last core for capture/MQTT, the rest for YOLO
+CPU_COUNT = os.cpu_count() or 1
+PIN_CPU_CORES = CPU_COUNT >= 3 and hasattr(os, "sched_setaffinity")
+KVS_CORES = {0}
+YOLO_CORES = set(range(1, CPU_COUNT - 1))
+IO_CORES = {CPU_COUNT - 1}
 
 # ==================== GLOBAL VARIABLES ====================
 # Frame queue for YOLO processing
 frame_queue = queue.Queue(maxsize=10)
-# Detection results for MQTT publishing
-latest_detection = None
+# Latest detection for MQTT publishing; YOLO overwrites it and sets det_ready
+det_slot = deque(maxlen=1)
+det_ready = threading.Event()
 # Flag to control threads
 running = True
 # Current commands from cloud
 cloud_commands = {}
 # AWS Profile to use
 aws_profile = "default"
+# Frozen credentials from setup_aws_credentials, reused by the KVS producer
+frozen_creds = None
 # Last time we processed a frame with YOLO
 last_yolo_process_time = 0
 # Last time we published to MQTT
@@ -101,11 +153,19 @@ last_mqtt_publish_time = 0
 skip_yolo = False
 # RTSP URL
 rtsp_url = "rtsp://10.31.50.195:554/live"
+# YOLO branch of the in-process KVS pipeline, None when KVS runs as a separate process
+frame_sink = None
+# Pipeline counters, each written by a single thread and read by the stats logger
+frames_dropped = 0
+detections_dropped = 0
+mqtt_publish_count = 0
+# Latency of the most recent YOLO predictions in milliseconds
+yolo_latency_ms = deque(maxlen=256)
 
 # ==================== AWS CREDENTIALS SETUP ====================
 def setup_aws_credentials(profile_name):
     """Set up AWS credentials for the script and KVS producer"""
-    global aws_profile
+    global aws_profile, frozen_creds
     
     print(f"Setting up AWS credentials using profile: {profile_name}")
     aws_profile = profile_name
@@ -126,6 +186,7 @@ def setup_aws_credentials(profile_name):
         
         # Get the frozen credentials to ensure they don't expire during our session
         frozen_credentials = credentials.get_frozen_credentials()
+        frozen_creds = frozen_credentials
         
         # Write credentials to file for KVS producer
         cred_data = {
@@ -137,12 +198,11 @@ def setup_aws_credentials(profile_name):
         if frozen_credentials.token:
             cred_data["sessionToken"] = frozen_credentials.token
             
-        # Write credentials to file in both locations
-        with open(".kvs/credential", "w") as f:
-            json.dump(cred_data, f)
-            
-        with open(os.path.join(kvs_cred_dir, "credential"), "w") as f:
-            json.dump(cred_data, f)
+        # Write credentials to file in both locations, this is the only place they are written
+        cred_json = orjson.dumps(cred_data)
+        for cred_path in (".kvs/credential", os.path.join(kvs_cred_dir, "credential")):
+            with open(cred_path, "wb") as f:
+                f.write(cred_json)
             
         # Also set environment variables for direct use
         os.environ['AWS_ACCESS_KEY_ID'] = frozen_credentials.access_key
@@ -167,6 +227,29 @@ def initialize_yolo():
         
     print("Initializing YOLOv11 model...")
     try:
+        # Prefer a TensorRT engine on CUDA devices, then the INT8 OpenVINO model on CPU,
+        # then ONNX Runtime, then the PyTorch weights, with NMS built into the exported
+        # graph so it runs in the runtime instead of Ultralytics' postprocess
+        candidates = [
+            (YOLO_OPENVINO_PATH, "openvino", {"int8": True, "data": "coco128.yaml", "nms": True, "imgsz": YOLO_INPUT_SIZE}),
+            (YOLO_ONNX_PATH, "onnx", {"nms": True, "imgsz": YOLO_INPUT_SIZE}),
+        ]
+        if torch.cuda.is_available():
+            candidates.insert(0, (YOLO_ENGINE_PATH, "engine", {"half": True, "device": 0, "nms": True, "imgsz": YOLO_INPUT_SIZE}))
+        
+        for model_path, export_format, export_args in candidates:
+            try:
+                if not os.path.exists(model_path):
+                    print(f"Exporting {YOLO_MODEL_PATH} to {export_format}, this can take several minutes...")
+                    # Ultralytics names exports after the weights; keep this one under a name that
+                    # records its export settings so other scripts' exports are never loaded by mistake
+                    os.replace(YOLO(YOLO_MODEL_PATH).export(format=export_format, **export_args), model_path)
+                model = YOLO(model_path, task="detect")
+                print(f"YOLO {export_format} model loaded successfully: {model_path}")
+                return model
+            except Exception as e:
+                print(f"YOLO {export_format} model unavailable: {str(e)}")
+        
         model = YOLO(YOLO_MODEL_PATH)
         print("YOLO model loaded successfully")
         return model
@@ -176,64 +259,111 @@ def initialize_yolo():
 
 def yolo_detection_thread(model):
     """Thread to run YOLO detection on frames"""
-    global latest_detection, last_yolo_process_time
+    global last_yolo_process_time, detections_dropped
     
     if skip_yolo or model is None:
         print("YOLO detection disabled, detection thread not starting")
         return
         
     print("Starting YOLO detection thread")
+    # Persistent model input, filled in place for every frame
+    tensor = torch.empty((1, 3, YOLO_INPUT_SIZE, YOLO_INPUT_SIZE), dtype=torch.float32)
+    if torch.cuda.is_available():
+        # Pinned host memory for a fast DMA copy to the GPU engine
+        tensor = tensor.pin_memory()
+    tensor_np = tensor.numpy()
+    # Thumbnail of the last frame YOLO ran on, and its detections for reuse while the scene is static
+    prev_small = None
+    last_inference_time = 0
+    detections = []
+    
     while running:
         try:
-            current_time = time.time()
+            # Let frames queue up until the next processing interval
+            wait = last_yolo_process_time + YOLO_PROCESSING_INTERVAL - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
             
-            # Only process frames at the specified interval
-            if current_time - last_yolo_process_time >= YOLO_PROCESSING_INTERVAL:
-                if not frame_queue.empty():
-                    frame_data = frame_queue.get()
-                    if frame_data is None:
-                        continue
-                    
-                    frame, timestamp = frame_data
-                    results = model(frame, conf=CONFIDENCE_THRESHOLD)
-                    
-                    detections = []
-                    for r in results:
-                        boxes = r.boxes
-                        for box in boxes:
-                            x1, y1, x2, y2 = box.xyxy[0]
-                            conf = float(box.conf[0])
-                            cls = int(box.cls[0])
-                            
-                            # If the class is in our list of interest, and confidence exceeds threshold
-                            if cls in CLASSES_OF_INTEREST and conf > CONFIDENCE_THRESHOLD:
-                                class_name = model.names[cls]
-                                detection = {
-                                    "box": [float(x1), float(y1), float(x2), float(y2)],
-                                    "class": class_name,
-                                    "class_id": cls,
-                                    "confidence": conf
-                                }
-                                detections.append(detection)
-                    
-                    # Update latest detection
-                    latest_detection = {
-                        "timestamp": timestamp,
-                        "detections": detections,
-                        "source": "edge"
+            # Block until a frame arrives, then skip to the newest one queued; only the latest
+            # detection is published, so older frames would be inferred for nothing
+            try:
+                frame, timestamp = frame_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            while True:
+                try:
+                    frame, timestamp = frame_queue.get_nowait()
+                except queue.Empty:
+                    break
+            
+            current_time = time.monotonic()
+            
+            # Skip inference when the frame barely differs from the last one YOLO saw
+            small = cv2.resize(frame, (MOTION_SIZE, MOTION_SIZE), interpolation=cv2.INTER_LINEAR)
+            if (prev_small is not None and current_time - last_inference_time < MOTION_MAX_SKIP
+                    and cv2.absdiff(small, prev_small).mean() < MOTION_THRESHOLD):
+                if det_ready.is_set():
+                    detections_dropped += 1
+                det_slot.append({
+                    "timestamp": timestamp,
+                    "detections": detections,
+                    "source": "edge"
+                })
+                det_ready.set()
+                last_yolo_process_time = current_time
+                continue
+            prev_small = small
+            last_inference_time = current_time
+            
+            # Resize, convert BGR to RGB, normalize and transpose to CHW in one SIMD pass,
+            # copied into the tensor; tensor input skips Ultralytics' own preprocessing
+            tensor_np[0] = cv2.dnn.blobFromImage(
+                frame, scalefactor=1 / 255.0, size=(YOLO_INPUT_SIZE, YOLO_INPUT_SIZE), swapRB=True, crop=False
+            )[0]
+            t0 = time.monotonic()
+            results = model.predict(tensor, conf=CONFIDENCE_THRESHOLD)
+            yolo_latency_ms.append((time.monotonic() - t0) * 1000)
+            
+            for r in results:
+                # Boxes come back in model input coordinates
+                sx = frame.shape[1] / YOLO_INPUT_SIZE
+                sy = frame.shape[0] / YOLO_INPUT_SIZE
+                
+                # Keep classes of interest above the threshold, filtering all boxes in one pass
+                xyxy = r.boxes.xyxy.cpu().numpy()
+                conf = r.boxes.conf.cpu().numpy()
+                cls = r.boxes.cls.cpu().numpy().astype(np.int32)
+                keep = CLS_MASK[cls] & (conf > CONFIDENCE_THRESHOLD)
+                xyxy = xyxy[keep] * np.array([sx, sy, sx, sy])
+                
+                detections = [
+                    {
+                        "box": box,
+                        "class": model.names[class_id],
+                        "class_id": class_id,
+                        "confidence": confidence
                     }
-                    
-                    # Update last process time
-                    last_yolo_process_time = current_time
-                    
-                    # Print detection summary
-                    if detections:
-                        print(f"Detected {len(detections)} objects: " + 
-                              ", ".join([f"{d['class']} ({d['confidence']:.2f})" for d in detections[:3]]) +
-                              ("..." if len(detections) > 3 else ""))
+                    for box, confidence, class_id in zip(xyxy.tolist(), conf[keep].tolist(), cls[keep].tolist())
+                ]
+                
+                # Print detection summary
+                if detections:
+                    print(f"Detected {len(detections)} objects: " + 
+                          ", ".join([f"{d['class']} ({d['confidence']:.2f})" for d in detections[:3]]) +
+                          ("..." if len(detections) > 3 else ""))
             
-            # Brief pause to prevent CPU overuse
-            time.sleep(0.01)
+            # Hand the detection to the MQTT thread, replacing any unpublished one
+            if det_ready.is_set():
+                detections_dropped += 1
+            det_slot.append({
+                "timestamp": timestamp,
+                "detections": detections,
+                "source": "edge"
+            })
+            det_ready.set()
+            
+            # Update last process time
+            last_yolo_process_time = current_time
         except Exception as e:
             print(f"Error in YOLO detection thread: {str(e)}")
             time.sleep(1)  # Pause on error before retrying
@@ -249,7 +379,7 @@ def initialize_iot():
         
         # Configure connection settings
         client.configureAutoReconnectBackoffTime(1, 32, 20)
-        client.configureOfflinePublishQueueing(-1)  # Infinite queueing
+        client.configureOfflinePublishQueueing(MQTT_OFFLINE_QUEUE_SIZE, DROP_OLDEST)
         client.configureDrainingFrequency(2)  # 2 Hz
         client.configureConnectDisconnectTimeout(10)
         client.configureMQTTOperationTimeout(5)
@@ -267,7 +397,7 @@ def setup_iot_subscriptions(client):
     def command_callback(client, userdata, message):
         """Callback for command messages"""
         try:
-            payload = json.loads(message.payload.decode('utf-8'))
+            payload = orjson.loads(message.payload)
             command = payload.get('command')
             timestamp = payload.get('timestamp', time.time())
             
@@ -290,30 +420,46 @@ def setup_iot_subscriptions(client):
 
 def mqtt_publish_thread(client):
     """Thread to publish detections to MQTT at regular intervals"""
-    global latest_detection, last_mqtt_publish_time
+    global last_mqtt_publish_time, mqtt_publish_count
     
     if client is None:
         print("IoT client not initialized, MQTT publish thread not starting")
         return
         
     print("Starting MQTT publish thread")
+    pin_current_thread(IO_CORES)
+    last_sent_hash = None
     while running:
         try:
-            current_time = time.time()
+            # Block until YOLO produces a detection
+            if not det_ready.wait(timeout=1.0):
+                continue
+            
+            # Only publish at the specified interval; newer detections replace this one meanwhile
+            wait = last_mqtt_publish_time + MQTT_PUBLISH_INTERVAL - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            det_ready.clear()
+            detection = det_slot[-1]
+            now = time.monotonic()
+            
+            # Skip unchanged detection sets (class + rounded box) until the keepalive is due
+            h = hash(tuple(
+                (d["class_id"], round(d["box"][0]), round(d["box"][1]), round(d["box"][2]), round(d["box"][3]))
+                for d in detection["detections"]
+            ))
+            if h == last_sent_hash and now - last_mqtt_publish_time < MQTT_KEEPALIVE_INTERVAL:
+                continue
             
-            # Only publish at the specified interval
-            if current_time - last_mqtt_publish_time >= MQTT_PUBLISH_INTERVAL:
-                if latest_detection is not None:
-                    # Publish detection to IoT Core
-                    topic = f"{IOT_TOPIC_PREFIX}/status/{IOT_THING_NAME}/detection"
-                    client.publish(topic, json.dumps(latest_detection), 0)
-                    print(f"Published detection to MQTT: {len(latest_detection['detections'])} objects")
-                    
-                    # Update last publish time
-                    last_mqtt_publish_time = current_time
+            # Publish detection to IoT Core
+            topic = f"{IOT_TOPIC_PREFIX}/status/{IOT_THING_NAME}/detection"
+            client.publish(topic, orjson.dumps(detection), 0)
+            print(f"Published detection to MQTT: {len(detection['detections'])} objects")
             
-            # Brief pause to prevent CPU overuse
-            time.sleep(0.1)
+            # Update last publish time
+            mqtt_publish_count += 1
+            last_sent_hash = h
+            last_mqtt_publish_time = now
         except Exception as e:
             print(f"Error in MQTT publish thread: {str(e)}")
             time.sleep(1)  # Pause on error before retrying
@@ -331,29 +477,16 @@ os.environ['KVSSINK_LOG_CONFIG_PATH'] = kvs_log_path
 os.environ['KVSSINK_VERBOSE_LOGGING'] = '1'  # Enable verbose logging
 
 def start_kvs_producer():
-    """Start the Kinesis Video Stream producer as a separate process"""
+    """Start the Kinesis Video Stream producer, in-process when possible, otherwise as a separate process"""
     try:
         print("Starting KVS producer...")
         
         # Ensure the log directory exists
         os.makedirs("log", exist_ok=True)
         
-        # Create .kvs directory directly in the KVS_PRODUCER_PATH
-        kvs_cred_dir = os.path.join(KVS_PRODUCER_PATH, '.kvs')
-        os.makedirs(kvs_cred_dir, exist_ok=True)
-        
-        # Read credentials from our local .kvs directory
-        try:
-            with open(".kvs/credential", "r") as src_file:
-                cred_data = json.load(src_file)
-                
-                # Write credentials to the KVS producer directory
-                with open(os.path.join(kvs_cred_dir, "credential"), "w") as dst_file:
-                    json.dump(cred_data, dst_file)
-                    
-            print(f"Copied credentials to {kvs_cred_dir}")
-        except Exception as e:
-            print(f"Error copying credentials: {str(e)}")
+        # Credentials were already written to KVS_PRODUCER_PATH/.kvs by setup_aws_credentials
+        if frozen_creds is None:
+            print("AWS credentials not set up, cannot start KVS producer")
             return None
         
         # Create log configuration directly in the KVS_PRODUCER_PATH
@@ -367,15 +500,12 @@ def start_kvs_producer():
         except FileNotFoundError:
             print("Log configuration file not found, continuing without it")
         
-        # Method 1: Direct pass-through (no transcoding)
+        # Method 1: Direct pass-through (no transcoding), run in-process and tee'd to YOLO
         # This is the most efficient method for RTSP streams that are already H.264 encoded
-        kvs_command = [
-            "gst-launch-1.0", "-v",
-            "rtspsrc", f"location={rtsp_url}", "short-header=TRUE", "!",
-            "rtph264depay", "!", "h264parse", "!",
-            "video/x-h264,stream-format=avc,alignment=au", "!",
-            "kvssink", f"stream-name={STREAM_NAME}", "storage-size=128"
-        ]
+        print(f"Using direct pass-through with RTSP source: {rtsp_url}")
+        pipeline = start_gst_pipeline()
+        if pipeline is not None:
+            return pipeline
         
         # Method 2: Use KVS GStreamer sample (fallback)
         kvs_sample_command = [
@@ -399,118 +529,89 @@ def start_kvs_producer():
             "-r", rtmp_url
         ]
         
-        # We'll use Method 1 (direct pass-through) as our primary approach
-        print(f"Using direct pass-through with RTSP source: {rtsp_url}")
-        
         # Set environment variables for the process
         env = os.environ.copy()
         env['LD_LIBRARY_PATH'] = f"{KVS_PRODUCER_PATH}:{os.environ.get('LD_LIBRARY_PATH', '')}"
         env['AWS_DEFAULT_REGION'] = AWS_REGION
-        env['GST_DEBUG'] = '2'  # Reduced debug level for better performance
+        env['GST_DEBUG'] = '1'  # Errors only, level 2 warnings cost measurable CPU
         env['GST_PLUGIN_PATH'] = KVS_PRODUCER_PATH  # Set GStreamer plugin path to find kvssink
         
-        # Explicitly set AWS credentials in environment variables
-        session = boto3.Session(profile_name=aws_profile)
-        credentials = session.get_credentials()
-        if credentials:
-            frozen_creds = credentials.get_frozen_credentials()
-            env['AWS_ACCESS_KEY_ID'] = frozen_creds.access_key
-            env['AWS_SECRET_ACCESS_KEY'] = frozen_creds.secret_key
-            if frozen_creds.token:
-                env['AWS_SESSION_TOKEN'] = frozen_creds.token
-            print("Added AWS credentials to environment variables")
-        
-        print(f"Executing KVS command: {' '.join(kvs_command)}")
-        print(f"With GST_PLUGIN_PATH: {env['GST_PLUGIN_PATH']}")
+        # Explicitly set AWS credentials in environment variables, from the credentials frozen at setup
+        env['AWS_ACCESS_KEY_ID'] = frozen_creds.access_key
+        env['AWS_SECRET_ACCESS_KEY'] = frozen_creds.secret_key
+        if frozen_creds.token:
+            env['AWS_SESSION_TOKEN'] = frozen_creds.token
+        print("Added AWS credentials to environment variables")
+        
         print(f"With LD_LIBRARY_PATH: {env['LD_LIBRARY_PATH']}")
         
         # Start process and capture output
         try:
+            # Read stdout and stderr of the process in one thread, in bulk
+            def read_output(process):
+                sel = selectors.DefaultSelector()
+                sel.register(process.stdout.fileno(), selectors.EVENT_READ, "KVS OUT")
+                sel.register(process.stderr.fileno(), selectors.EVENT_READ, "KVS ERR")
+                partial = {}
+                try:
+                    while sel.get_map():
+                        for key, _ in sel.select(1.0):
+                            chunk = os.read(key.fd, 65536)
+                            if not chunk:
+                                sel.unregister(key.fd)
+                                continue
+                            # Keep the trailing partial line for the next read
+                            lines = (partial.pop(key.fd, b'') + chunk).split(b'\n')
+                            if lines[-1]:
+                                partial[key.fd] = lines[-1]
+                            for line in lines[:-1]:
+                                # Only print important messages (errors, warnings)
+                                if b"ERROR" in line or b"WARN" in line:
+                                    print(f"{key.data}: {line.strip().decode(errors='replace')}")
+                except Exception as e:
+                    print(f"Error in KVS output reader thread: {str(e)}")
+                finally:
+                    sel.close()
+            
+            # Try Method 2 if Method 1 fails (KVS GStreamer sample)
+            print("Method 1 failed. Trying Method 2 with KVS GStreamer sample...")
             process = subprocess.Popen(
-                kvs_command,
+                kvs_sample_command,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                text=True,  # Enable text mode for easier reading
-                bufsize=1,   # Line buffered
-                env=env      # Pass environment variables
+                env=env,
+                cwd=KVS_PRODUCER_PATH
             )
             
-            print(f"Started KVS producer with PID: {process.pid}")
+            # Set up output reader for Method 2
+            reader_thread = threading.Thread(target=read_output, args=(process,))
+            reader_thread.daemon = True
+            reader_thread.start()
             
-            # Create threads to read output
-            def read_output(pipe, prefix):
-                try:
-                    for line in iter(pipe.readline, ''):
-                        # Only print important messages (errors, warnings)
-                        if "ERROR" in line or "WARN" in line:
-                            print(f"{prefix}: {line.strip()}")
-                except Exception as e:
-                    print(f"Error in {prefix} reader thread: {str(e)}")
-                    
-            stdout_thread = threading.Thread(target=read_output, args=(process.stdout, "KVS OUT"))
-            stderr_thread = threading.Thread(target=read_output, args=(process.stderr, "KVS ERR"))
-            stdout_thread.daemon = True
-            stderr_thread.daemon = True
-            stdout_thread.start()
-            stderr_thread.start()
-            
-            # Check if process is running
+            # Check if Method 2 is running
             time.sleep(1)
             if process.poll() is not None:
-                print(f"KVS process exited immediately with code: {process.returncode}")
-                stdout, stderr = process.communicate()
-                print(f"KVS stdout: {stdout}")
-                print(f"KVS stderr: {stderr}")
+                print(f"Method 2 failed. Trying Method 3 with RTMP...")
                 
-                # Try Method 2 if Method 1 fails (KVS GStreamer sample)
-                print("Method 1 failed. Trying Method 2 with KVS GStreamer sample...")
+                # Try Method 3 (RTMP) if Method 2 fails
                 process = subprocess.Popen(
-                    kvs_sample_command,
+                    rtmp_command,
                     stdout=subprocess.PIPE,
                     stderr=subprocess.PIPE,
-                    text=True,
-                    bufsize=1,
                     env=env,
                     cwd=KVS_PRODUCER_PATH
                 )
                 
-                # Set up output readers for Method 2
-                stdout_thread = threading.Thread(target=read_output, args=(process.stdout, "KVS OUT"))
-                stderr_thread = threading.Thread(target=read_output, args=(process.stderr, "KVS ERR"))
-                stdout_thread.daemon = True
-                stderr_thread.daemon = True
-                stdout_thread.start()
-                stderr_thread.start()
+                # Set up output reader for Method 3
+                reader_thread = threading.Thread(target=read_output, args=(process,))
+                reader_thread.daemon = True
+                reader_thread.start()
                 
-                # Check if Method 2 is running
+                # Check if Method 3 is running
                 time.sleep(1)
                 if process.poll() is not None:
-                    print(f"Method 2 failed. Trying Method 3 with RTMP...")
-                    
-                    # Try Method 3 (RTMP) if Method 2 fails
-                    process = subprocess.Popen(
-                        rtmp_command,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True,
-                        bufsize=1,
-                        env=env,
-                        cwd=KVS_PRODUCER_PATH
-                    )
-                    
-                    # Set up output readers for Method 3
-                    stdout_thread = threading.Thread(target=read_output, args=(process.stdout, "KVS OUT"))
-                    stderr_thread = threading.Thread(target=read_output, args=(process.stderr, "KVS ERR"))
-                    stdout_thread.daemon = True
-                    stderr_thread.daemon = True
-                    stdout_thread.start()
-                    stderr_thread.start()
-                    
-                    # Check if Method 3 is running
-                    time.sleep(1)
-                    if process.poll() is not None:
-                        print(f"All methods failed. Last exit code: {process.returncode}")
-                        return None
+                    print(f"All methods failed. Last exit code: {process.returncode}")
+                    return None
             
             return process
         except Exception as e:
@@ -521,9 +622,119 @@ def start_kvs_producer():
         traceback.print_exc()
         return None
 
+def select_h264_decoder():
+    """Return the decode chain of the first available H.264 decoder in H264_DECODERS"""
+    for element, decode in H264_DECODERS:
+        if Gst.ElementFactory.find(element) is not None:
+            print(f"Decoding YOLO frames with {element}")
+            return decode
+    return "avdec_h264"
+
+def build_kvs_pipeline():
+    """Build the RTSP to kvssink pipeline, tee'd into a BGR appsink for YOLO unless YOLO is skipped"""
+    source = f"rtspsrc location={rtsp_url} short-header=TRUE ! rtph264depay"
+    # The queue gives the KVS branch its own streaming thread, pinned to the KVS cores once it starts
+    kvs = ("queue name=kvsq ! h264parse ! video/x-h264,stream-format=avc,alignment=au ! "
+           f"kvssink stream-name={STREAM_NAME} storage-size=128")
+    if skip_yolo:
+        return f"{source} ! {kvs}"
+    
+    # One RTSP connection and one decoder shared by KVS (no decode) and YOLO;
+    # the appsink keeps at most two frames and drops older ones. The YOLO branch's queue leaks
+    # so a decoder that falls behind drops detection frames instead of blocking the tee and KVS
+    return (f"{source} ! tee name=t "
+            f"t. ! {kvs} "
+            f"t. ! queue leaky=downstream max-size-buffers={YOLO_QUEUE_BUFFERS} max-size-bytes=0 max-size-time=0 ! "
+            f"h264parse ! {select_h264_decoder()} ! videoconvert ! video/x-raw,format=BGR ! "
+            "appsink name=ysink max-buffers=2 drop=true sync=false")
+
+def start_gst_pipeline():
+    """Start the KVS pipeline in this process, returns it or None if it fails to start"""
+    global frame_sink
+    
+    if Gst is None:
+        print("GStreamer Python bindings not available")
+        return None
+    
+    try:
+        # kvssink is loaded from the producer build; GStreamer reads these at init
+        os.environ['GST_PLUGIN_PATH'] = KVS_PRODUCER_PATH
+        os.environ['GST_DEBUG'] = '1'  # Errors only, level 2 warnings cost measurable CPU
+        Gst.init(None)
+        
+        description = build_kvs_pipeline()
+        print(f"Launching KVS pipeline: {description}")
+        pipeline = Gst.parse_launch(description)
+        
+        # Streaming threads inherit the YOLO cores from this thread; only the KVS branch
+        # moves to the KVS cores, from inside its own thread before kvssink sees any data
+        pipeline.get_by_name("kvsq").get_static_pad("src").add_probe(
+            Gst.PadProbeType.DATA_DOWNSTREAM, pin_kvs_branch)
+        ret = pipeline.set_state(Gst.State.PLAYING)
+        
+        # Give the pipeline a second to fail, as with the producer processes
+        msg = None
+        if ret != Gst.StateChangeReturn.FAILURE:
+            msg = pipeline.get_bus().timed_pop_filtered(Gst.SECOND, Gst.MessageType.ERROR | Gst.MessageType.EOS)
+        if ret == Gst.StateChangeReturn.FAILURE or msg is not None:
+            if msg is not None and msg.type == Gst.MessageType.ERROR:
+                err, debug = msg.parse_error()
+                print(f"KVS pipeline error: {err.message} ({debug})")
+            print("KVS pipeline failed to start")
+            pipeline.set_state(Gst.State.NULL)
+            return None
+        
+        frame_sink = pipeline.get_by_name("ysink")
+        print("Started KVS pipeline in-process")
+        return pipeline
+    except Exception as e:
+        print(f"Failed to start KVS pipeline: {str(e)}")
+        return None
+
+def pin_kvs_branch(pad, info):
+    """Pad probe that pins the KVS branch's streaming thread to the KVS cores, then removes itself"""
+    pin_current_thread(KVS_CORES)
+    return Gst.PadProbeReturn.REMOVE
+
+def log_pipeline_messages(pipeline):
+    """Print errors and warnings posted by the KVS pipeline since the last call"""
+    bus = pipeline.get_bus()
+    while True:
+        msg = bus.pop_filtered(Gst.MessageType.ERROR | Gst.MessageType.WARNING)
+        if msg is None:
+            return
+        if msg.type == Gst.MessageType.ERROR:
+            err, debug = msg.parse_error()
+            print(f"KVS ERR: {err.message}")
+        else:
+            warn, debug = msg.parse_warning()
+            print(f"KVS WARN: {warn.message}")
+
+def stop_kvs_producer(kvs_process):
+    """Stop the in-process KVS pipeline or the producer process"""
+    if isinstance(kvs_process, subprocess.Popen):
+        kvs_process.terminate()
+    else:
+        kvs_process.set_state(Gst.State.NULL)
+
+def pull_frame():
+    """Pull the next BGR frame from the pipeline's YOLO appsink, None if none arrives in time"""
+    # Time out so the capture loop still notices shutdown
+    sample = frame_sink.emit("try-pull-sample", 500 * Gst.MSECOND)
+    if sample is None:
+        return None
+    
+    caps = sample.get_caps().get_structure(0)
+    width = caps.get_value("width")
+    height = caps.get_value("height")
+    buffer = sample.get_buffer()
+    data = buffer.extract_dup(0, buffer.get_size())
+    # Rows may be padded to 4 bytes
+    return np.frombuffer(data, dtype=np.uint8).reshape(height, -1)[:, :width * 3].reshape(height, width, 3)
+
 def capture_video_thread():
     """Thread to capture video frames for YOLO processing"""
-    global running
+    global running, frames_dropped
     
     if skip_yolo:
         print("YOLO detection disabled, video capture thread not starting")
@@ -531,26 +742,38 @@ def capture_video_thread():
         
     try:
         print(f"Starting video capture thread for YOLO processing")
-        # Try RTSP stream first, fall back to local camera if that fails
-        cap = cv2.VideoCapture(rtsp_url)
-        if not cap.isOpened():
-            print(f"Failed to open RTSP stream at {rtsp_url}, falling back to local camera")
-            cap = cv2.VideoCapture(VIDEO_DEVICE)
+        pin_current_thread(IO_CORES)
+        
+        cap = None
+        if frame_sink is not None:
+            # Frames are decoded by the KVS pipeline's YOLO branch
+            print("Reading frames from the KVS pipeline")
+        else:
+            # KVS runs as a separate process: open our own capture,
+            # trying the RTSP stream first and falling back to local camera if that fails
+            cap = cv2.VideoCapture(rtsp_url)
+            if not cap.isOpened():
+                print(f"Failed to open RTSP stream at {rtsp_url}, falling back to local camera")
+                cap = cv2.VideoCapture(VIDEO_DEVICE)
+                
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
+            cap.set(cv2.CAP_PROP_FPS, FPS)
             
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
-        cap.set(cv2.CAP_PROP_FPS, FPS)
-        
-        if not cap.isOpened():
-            print("Failed to open video device")
-            return
+            if not cap.isOpened():
+                print("Failed to open video device")
+                return
         
         print("Video capture started")
         frame_count = 0
-        start_time = time.time()
+        start_time = time.monotonic()
         
         while running:
-            ret, frame = cap.read()
+            if cap is None:
+                frame = pull_frame()
+                ret = frame is not None
+            else:
+                ret, frame = cap.read()
             if not ret:
                 print("Failed to read frame")
                 time.sleep(0.1)
@@ -561,25 +784,54 @@ def capture_video_thread():
             
             # Calculate and print FPS every 5 seconds
             if frame_count % 100 == 0:
-                elapsed = time.time() - start_time
+                elapsed = time.monotonic() - start_time
                 fps = frame_count / elapsed
                 print(f"Video capture running at {fps:.2f} FPS")
             
             # Put frame in queue for YOLO processing
-            # Only if queue is not full to prevent memory buildup
-            if not frame_queue.full():
-                frame_queue.put((frame.copy(), timestamp))
-            else:
-                # If queue is full, skip this frame
-                pass
+            # If queue is full, skip this frame to prevent memory buildup
+            try:
+                frame_queue.put_nowait((frame, timestamp))
+            except queue.Full:
+                frames_dropped += 1
         
         # Clean up
-        cap.release()
+        if cap is not None:
+            cap.release()
     
     except Exception as e:
         print(f"Error in video capture thread: {str(e)}")
         running = False
 
+# ==================== CPU AFFINITY ====================
+def pin_current_thread(cores):
+    """Restrict the calling thread, and threads it starts later, to the given cores"""
+    if PIN_CPU_CORES:
+        os.sched_setaffinity(0, cores)
+
+def pin_process(pid, cores):
+    """Restrict every thread of a running process to the given cores"""
+    if not PIN_CPU_CORES:
+        return
+    for tid in os.listdir(f"/proc/{pid}/task"):
+        try:
+            os.sched_setaffinity(int(tid), cores)
+        except OSError:
+            pass  # Thread exited meanwhile
+
+# ==================== INSTRUMENTATION ====================
+def log_pipeline_stats(elapsed, published):
+    """Log queue depth, drop counts, YOLO latency and MQTT publish rate"""
+    latencies = list(yolo_latency_ms)
+    if latencies:
+        p50, p99 = np.percentile(latencies, [50, 99])
+        latency = f"yolo_p50={p50:.1f}ms yolo_p99={p99:.1f}ms"
+    else:
+        latency = "yolo_p50=n/a yolo_p99=n/a"
+    print(f"Stats: queue_depth={frame_queue.qsize()} {latency} "
+          f"frames_dropped={frames_dropped} detections_dropped={detections_dropped} "
+          f"mqtt_rate={published / elapsed:.2f}/s")
+
 # ==================== MAIN FUNCTION ====================
 def main():
     """Main function"""
@@ -609,6 +861,14 @@ def main():
             print("Failed to set up AWS credentials. Exiting.")
             return
         
+        # Keep YOLO's thread pools off the KVS and capture/MQTT cores; threads started
+        # from here on inherit the YOLO cores until they pin themselves elsewhere
+        if PIN_CPU_CORES:
+            print(f"CPU cores: KVS {sorted(KVS_CORES)}, YOLO {sorted(YOLO_CORES)}, capture/MQTT {sorted(IO_CORES)}")
+            torch.set_num_threads(len(YOLO_CORES))
+            torch.set_num_interop_threads(1)
+            pin_current_thread(YOLO_CORES)
+        
         # Initialize YOLO model (if not skipped)
         model = initialize_yolo()
         
@@ -622,6 +882,8 @@ def main():
         if kvs_process is None:
             print("Failed to start KVS producer. Exiting.")
             return
+        if isinstance(kvs_process, subprocess.Popen):
+            pin_process(kvs_process.pid, KVS_CORES)
         
         # Start threads
         threads = []
@@ -650,8 +912,20 @@ def main():
         
         # Keep main thread alive
         try:
+            last_stats_time = time.monotonic()
+            last_publish_count = 0
             while running:
                 time.sleep(1)
+                if not isinstance(kvs_process, subprocess.Popen):
+                    log_pipeline_messages(kvs_process)
+                
+                # Periodically log pipeline counters to guide interval and queue size tuning
+                now = time.monotonic()
+                if now - last_stats_time >= STATS_LOG_INTERVAL:
+                    published = mqtt_publish_count
+                    log_pipeline_stats(now - last_stats_time, published - last_publish_count)
+                    last_stats_time = now
+                    last_publish_count = published
         except KeyboardInterrupt:
             print("Interrupted by user")
             running = False
@@ -659,7 +933,7 @@ def main():
         # Cleanup
         print("Shutting down...")
         if kvs_process:
-            kvs_process.terminate()
+            stop_kvs_producer(kvs_process)
         
         if iot_client:
             iot_client.disconnect()
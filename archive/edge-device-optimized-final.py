@@ -10,9 +10,12 @@ This script integrates:
 Requirements:
 - Python 3.8+
 - ultralytics package (pip install ultralytics)
+- TensorRT (optional, for the exported .engine model on CUDA devices)
 - boto3 (pip install boto3)
 - AWSIoTPythonSDK (pip install AWSIoTPythonSDK)
 - opencv-python (pip install opencv-python)
+- orjson (pip install orjson)
+- numba (pip install numba)
 - Amazon Kinesis Video Streams Producer SDK (requires separate installation)
 
 Before running, configure AWS credentials and update the CONFIG section.
@@ -27,8 +30,9 @@ Usage:
 
 import os
 import sys
+import re
 import time
-import json
+import orjson
 import threading
 import queue
 import cv2
@@ -37,7 +41,10 @@ import boto3
 import subprocess
 import argparse
 import traceback
-from datetime import datetime
+import torch
+from collections import deque
+from numba import njit
+from concurrent.futures import ThreadPoolExecutor, wait
 from ultralytics import YOLO
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 
@@ -58,14 +65,26 @@ FRAME_WIDTH = 1280
 FRAME_HEIGHT = 720
 FPS = 30  # Increased from 15 to 30 for smoother streaming
 KVS_PRODUCER_PATH = "/mnt/c/code/ADRVE/adrve-edge/amazon-kinesis-video-streams-producer-sdk-cpp/build"
+KVS_CRED_DIR = os.path.join(KVS_PRODUCER_PATH, '.kvs')
 
 # KVS Optimization Parameters
 KVS_STORAGE_SIZE = 1024       # Increased from 128 to 512 MB
-KVS_FRAGMENT_DURATION = 1000 # 2 seconds (in milliseconds)
 KVS_MAX_LATENCY = 0          # Minimize latency
+KVS_FRAGMENT_TARGET = 1000   # Desired fragment length (in milliseconds), bounds cloud-side latency
+CAMERA_GOP_FRAMES = 30       # Camera keyframe interval (1 s at 30 FPS), set to match the camera's encoder
+# key-frame-fragmentation starts a fragment on every keyframe, so use a whole number of GOPs;
+# a GOP longer than KVS_FRAGMENT_TARGET lengthens every fragment, and cloud latency, to one GOP
+KVS_GOP_DURATION = CAMERA_GOP_FRAMES * 1000 // FPS
+KVS_FRAGMENT_DURATION = max(1, round(KVS_FRAGMENT_TARGET / KVS_GOP_DURATION)) * KVS_GOP_DURATION
 
 # YOLO Configuration
 YOLO_MODEL_PATH = "yolo11n.pt"  # Will be downloaded if not present
+YOLO_ENGINE_INT8 = False  # INT8 needs a calibration dataset; FP16 otherwise
+YOLO_INPUT_SIZE = (384, 640)  # (height, width) the engine is built for
+# Named after its export settings, as other scripts export the same weights with different shapes
+YOLO_ENGINE_PATH = f"yolo11n_{YOLO_INPUT_SIZE[0]}x{YOLO_INPUT_SIZE[1]}_{'int8' if YOLO_ENGINE_INT8 else 'fp16'}.engine"  # TensorRT engine, exported from YOLO_MODEL_PATH on first run
+YOLO_DEVICE = 0 if torch.cuda.is_available() else "cpu"
+YOLO_HALF = torch.cuda.is_available()  # FP16 inference needs a CUDA device
 CONFIDENCE_THRESHOLD = 0.3
 # Classes we're particularly interested in (subset of COCO)
 CLASSES_OF_INTEREST = [
@@ -80,24 +99,72 @@ CLASSES_OF_INTEREST = [
     17,  # cat
     18,  # horse
 ]
+# Lookup mask indexed by COCO class id
+COI_MASK = np.zeros(80, dtype=bool)
+COI_MASK[CLASSES_OF_INTEREST] = True
+
+# Display Configuration
+OVERLAY_HEIGHT = 64  # Rows at the top of the frame that hold the text overlays
 
 # Performance Configuration
 YOLO_PROCESSING_INTERVAL = 0.2  # Process frames every 0.2 seconds (5 FPS for YOLO)
+FRAME_HASH_THRESHOLD = 2        # Skip YOLO when a frame's hash differs from the last one by <= this many bits
+FRAME_HASH_MAX_SKIP = 5.0       # ...but still re-run YOLO at least this often (seconds)
 MQTT_PUBLISH_INTERVAL = 1.0     # Publish detections every 1 second
+MQTT_BATCH_SIZE = 16            # ...or as soon as this many detections are queued
+
+# ==================== FRAME HANDOFF ====================
+class LatestSlot:
+    """Single-slot handoff between two threads where a new item replaces any unread one"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._item = None
+    
+    def put(self, item):
+        """Store item and return the unread item it replaced, if any"""
+        with self._lock:
+            replaced, self._item = self._item, item
+            self._ready.set()
+        return replaced
+    
+    def get(self, timeout=None):
+        """Wait for and take the newest item, returns None on timeout"""
+        if not self._ready.wait(timeout):
+            return None
+        with self._lock:
+            item, self._item = self._item, None
+            self._ready.clear()
+        return item
 
 # ==================== GLOBAL VARIABLES ====================
-# Frame queue for YOLO processing
-frame_queue = queue.Queue(maxsize=10)
+# Newest frame for YOLO processing (a frame_ring index), older unprocessed frames are dropped
+frame_slot = LatestSlot()
+# Pre-allocated model-sized frame buffers, reused instead of copying every frame
+# (one waiting in frame_slot, one being processed, one being filled)
+FRAME_RING_SIZE = 3
+frame_ring = [np.empty((*YOLO_INPUT_SIZE, 3), dtype=np.uint8) for _ in range(FRAME_RING_SIZE)]
+# Ring slots not currently held by the YOLO thread
+free_slots = queue.Queue()
+for _slot in range(FRAME_RING_SIZE):
+    free_slots.put(_slot)
 # Detection results queue
 detection_queue = queue.Queue(maxsize=10)
+# Most recent detection result, for the display overlay
+latest_detection = {"data": None, "lock": threading.Lock()}
 # Flag to control threads
 running = True
-# Current commands from cloud
-cloud_commands = {}
+# Worker pool for the YOLO, MQTT and KVS output reader tasks
+executor = None
+# Most recent KVS producer errors and warnings
+kvs_log_lines = deque(maxlen=256)
+# Current commands from cloud, as (timestamp, payload) in arrival order
+cloud_commands = deque()
 # AWS Profile to use
 aws_profile = "default"
-# Last time we processed a frame with YOLO
-last_yolo_process_time = 0
+# Frozen credentials from setup_aws_credentials, reused by the KVS producer
+frozen_credentials = None
 # Last time we published to MQTT
 last_mqtt_publish_time = 0
 # RTSP URL
@@ -108,7 +175,7 @@ display_video = True
 # ==================== AWS CREDENTIALS SETUP ====================
 def setup_aws_credentials(profile_name):
     """Set up AWS credentials for the script and KVS producer"""
-    global aws_profile
+    global aws_profile, frozen_credentials
     
     print(f"Setting up AWS credentials using profile: {profile_name}")
     aws_profile = profile_name
@@ -124,8 +191,7 @@ def setup_aws_credentials(profile_name):
             
         # Create .kvs directory if it doesn't exist
         os.makedirs(".kvs", exist_ok=True)
-        kvs_cred_dir = os.path.join(KVS_PRODUCER_PATH, '.kvs')
-        os.makedirs(kvs_cred_dir, exist_ok=True)
+        os.makedirs(KVS_CRED_DIR, exist_ok=True)
         
         # Get the frozen credentials to ensure they don't expire during our session
         frozen_credentials = credentials.get_frozen_credentials()
@@ -141,11 +207,12 @@ def setup_aws_credentials(profile_name):
             cred_data["sessionToken"] = frozen_credentials.token
             
         # Write credentials to file in both locations
-        with open(".kvs/credential", "w") as f:
-            json.dump(cred_data, f)
+        cred_json = orjson.dumps(cred_data)
+        with open(".kvs/credential", "wb") as f:
+            f.write(cred_json)
             
-        with open(os.path.join(kvs_cred_dir, "credential"), "w") as f:
-            json.dump(cred_data, f)
+        with open(os.path.join(KVS_CRED_DIR, "credential"), "wb") as f:
+            f.write(cred_json)
             
         # Also set environment variables for direct use
         os.environ['AWS_ACCESS_KEY_ID'] = frozen_credentials.access_key
@@ -162,77 +229,144 @@ def setup_aws_credentials(profile_name):
         return False
 
 # ==================== YOLO MODEL ====================
+def export_yolo_engine():
+    """Export the YOLO model to a TensorRT engine"""
+    print(f"Exporting {YOLO_MODEL_PATH} to TensorRT ({'INT8' if YOLO_ENGINE_INT8 else 'FP16'}), this can take several minutes...")
+    export_args = {"format": "engine", "half": True, "imgsz": YOLO_INPUT_SIZE}
+    if YOLO_ENGINE_INT8:
+        export_args.update(int8=True, data="coco128.yaml")
+    # Ultralytics names exports after the weights; keep this one under a name that
+    # records its export settings so other scripts' exports are never loaded by mistake
+    os.replace(YOLO(YOLO_MODEL_PATH).export(**export_args), YOLO_ENGINE_PATH)
+    return YOLO_ENGINE_PATH
+
 def initialize_yolo():
     """Initialize and return YOLO model"""
     print("Initializing YOLOv11 model...")
     try:
-        model = YOLO(YOLO_MODEL_PATH)
-        print("YOLO model loaded successfully")
+        engine_path = YOLO_ENGINE_PATH
+        if not os.path.exists(engine_path) and torch.cuda.is_available():
+            try:
+                engine_path = export_yolo_engine()
+            except Exception as e:
+                print(f"TensorRT export failed, using PyTorch model: {str(e)}")
+        
+        if os.path.exists(engine_path):
+            model = YOLO(engine_path, task="detect")
+            print(f"YOLO TensorRT engine loaded successfully: {engine_path}")
+        else:
+            model = YOLO(YOLO_MODEL_PATH)
+            # Fold Conv+BN once here rather than on the first prediction
+            model.fuse()
+            if YOLO_HALF:
+                model.to("cuda").half()
+            print(f"YOLO model loaded successfully ({'FP16' if YOLO_HALF else 'FP32'})")
         return model
     except Exception as e:
         print(f"Failed to load YOLO model: {str(e)}")
         sys.exit(1)
 
+def warmup_yolo(model):
+    """Run a few dummy predictions so CUDA init and cuDNN autotune happen before streaming"""
+    print("Warming up YOLO model...")
+    if YOLO_DEVICE != "cpu":
+        # Every frame has the same shape (YOLO_INPUT_SIZE), so autotune once and keep it
+        torch.backends.cudnn.benchmark = True
+    dummy = np.zeros((*YOLO_INPUT_SIZE, 3), dtype=np.uint8)
+    with torch.inference_mode():
+        for _ in range(3):
+            model.predict(dummy, imgsz=YOLO_INPUT_SIZE, half=YOLO_HALF, device=YOLO_DEVICE, verbose=False)
+
+def allocate_input_tensor():
+    """Allocate the persistent (1, 3, H, W) model input, in pinned host memory on CUDA"""
+    tensor = torch.empty((1, 3, *YOLO_INPUT_SIZE), dtype=torch.float16 if YOLO_HALF else torch.float32)
+    return tensor.pin_memory() if YOLO_DEVICE != "cpu" else tensor
+
+def preprocess_frame(frame, out):
+    """Convert a model-sized BGR uint8 frame to normalized RGB CHW in out, in one pass"""
+    np.divide(frame[..., ::-1].transpose(2, 0, 1), 255.0, out=out[0], dtype=out.dtype)
+
+@njit(cache=True)
+def postprocess(xyxy, conf, cls, coi_mask, thr, sx, sy):
+    """Keep classes of interest above thr with boxes scaled to the source frame, as (N, 6) x1,y1,x2,y2,conf,cls"""
+    out = np.empty((xyxy.shape[0], 6), dtype=np.float32)
+    n = 0
+    for i in range(xyxy.shape[0]):
+        c = int(cls[i])
+        if c < coi_mask.shape[0] and coi_mask[c] and conf[i] > thr:
+            out[n, 0] = xyxy[i, 0] * sx
+            out[n, 1] = xyxy[i, 1] * sy
+            out[n, 2] = xyxy[i, 2] * sx
+            out[n, 3] = xyxy[i, 3] * sy
+            out[n, 4] = conf[i]
+            out[n, 5] = c
+            n += 1
+    return out[:n]
+
 def yolo_detection_thread(model):
     """Thread to run YOLO detection on frames"""
-    global last_yolo_process_time
-    
     print("Starting YOLO detection thread")
+    # Host staging tensor and a NumPy view sharing its memory
+    input_tensor = allocate_input_tensor()
+    input_array = input_tensor.numpy()
+    device = "cpu" if YOLO_DEVICE == "cpu" else f"cuda:{YOLO_DEVICE}"
     while running:
         try:
-            current_time = time.time()
+            # Block until the capture loop hands over a frame; it already rate-limits
+            frame_data = frame_slot.get(timeout=0.5)
+            if frame_data is None:
+                continue
             
-            # Only process frames at the specified interval
-            if current_time - last_yolo_process_time >= YOLO_PROCESSING_INTERVAL:
-                if not frame_queue.empty():
-                    frame_data = frame_queue.get()
-                    if frame_data is None:
-                        continue
-                    
-                    frame, timestamp = frame_data
-                    results = model(frame, conf=CONFIDENCE_THRESHOLD)
-                    
-                    detections = []
-                    for r in results:
-                        boxes = r.boxes
-                        for box in boxes:
-                            x1, y1, x2, y2 = box.xyxy[0]
-                            conf = float(box.conf[0])
-                            cls = int(box.cls[0])
-                            
-                            # If the class is in our list of interest, and confidence exceeds threshold
-                            if cls in CLASSES_OF_INTEREST and conf > CONFIDENCE_THRESHOLD:
-                                class_name = model.names[cls]
-                                detection = {
-                                    "box": [float(x1), float(y1), float(x2), float(y2)],
-                                    "class": class_name,
-                                    "class_id": cls,
-                                    "confidence": conf
-                                }
-                                detections.append(detection)
-                    
-                    # Put results in the detection queue
-                    detection_result = {
-                        "timestamp": timestamp,
-                        "detections": detections,
-                        "source": "edge"
-                    }
-                    
-                    # Only add to queue if not full
-                    if not detection_queue.full():
-                        detection_queue.put((frame, detection_result))
-                    
-                    # Update last process time
-                    last_yolo_process_time = current_time
-                    
-                    # Print detection summary
-                    if detections:
-                        print(f"Detected {len(detections)} objects: " + 
-                              ", ".join([f"{d['class']} ({d['confidence']:.2f})" for d in detections[:3]]) +
-                              ("..." if len(detections) > 3 else ""))
+            idx, timestamp, (sx, sy) = frame_data
+            try:
+                preprocess_frame(frame_ring[idx], input_array)
+            finally:
+                # The frame now lives in the input tensor, hand the ring slot back
+                free_slots.put(idx)
+            
+            # Tensor input skips Ultralytics' letterbox/transpose/normalize steps
+            with torch.inference_mode():
+                results = model.predict(input_tensor.to(device, non_blocking=True),
+                                        conf=CONFIDENCE_THRESHOLD, imgsz=YOLO_INPUT_SIZE,
+                                        half=YOLO_HALF, device=YOLO_DEVICE,
+                                        classes=CLASSES_OF_INTEREST, verbose=False)
+            
+            detections = []
+            for r in results:
+                b = r.boxes
+                # Filter to classes of interest and scale back to source frame coordinates
+                kept = postprocess(b.xyxy.cpu().numpy(), b.conf.cpu().numpy(), b.cls.cpu().numpy(),
+                                   COI_MASK, CONFIDENCE_THRESHOLD, sx, sy)
+                
+                # NumPy values are kept as-is; orjson serializes them directly
+                for row in kept:
+                    c = int(row[5])
+                    detections.append({
+                        "box": row[:4],
+                        "class": model.names[c],
+                        "class_id": c,
+                        "confidence": row[4]
+                    })
             
-            # Brief pause to prevent CPU overuse
-            time.sleep(0.01)
+            # Put results in the detection queue
+            detection_result = {
+                "timestamp": timestamp,
+                "detections": detections,
+                "source": "edge"
+            }
+            
+            with latest_detection["lock"]:
+                latest_detection["data"] = detection_result
+            
+            # Only add to queue if not full
+            if not detection_queue.full():
+                detection_queue.put((timestamp, detection_result))
+            
+            # Print detection summary
+            if detections:
+                print(f"Detected {len(detections)} objects: " + 
+                      ", ".join([f"{d['class']} ({d['confidence']:.2f})" for d in detections[:3]]) +
+                      ("..." if len(detections) > 3 else ""))
         except Exception as e:
             print(f"Error in YOLO detection thread: {str(e)}")
             time.sleep(1)  # Pause on error before retrying
@@ -266,12 +400,12 @@ def setup_iot_subscriptions(client):
     def command_callback(client, userdata, message):
         """Callback for command messages"""
         try:
-            payload = json.loads(message.payload.decode('utf-8'))
+            payload = orjson.loads(message.payload)
             command = payload.get('command')
             timestamp = payload.get('timestamp', time.time())
             
-            # Store in global commands dict
-            cloud_commands[timestamp] = payload
+            # Store in global commands deque
+            cloud_commands.append((timestamp, payload))
             
             print(f"Received command: {command}")
             
@@ -296,25 +430,38 @@ def mqtt_publish_thread(client):
         return
         
     print("Starting MQTT publish thread")
+    topic = f"{IOT_TOPIC_PREFIX}/status/{IOT_THING_NAME}/detection"
+    batch = []
     while running:
         try:
-            current_time = time.time()
+            # Wait for the first detection, or until the pending batch is due
+            if batch:
+                wait_time = last_mqtt_publish_time + MQTT_PUBLISH_INTERVAL - time.time()
+            else:
+                wait_time = 0.5
+            if wait_time > 0:
+                try:
+                    batch.append(detection_queue.get(timeout=wait_time)[1])
+                except queue.Empty:
+                    pass
             
-            # Only publish at the specified interval
-            if current_time - last_mqtt_publish_time >= MQTT_PUBLISH_INTERVAL:
-                if not detection_queue.empty():
-                    _, detection_data = detection_queue.get()
-                    
-                    # Publish detection to IoT Core
-                    topic = f"{IOT_TOPIC_PREFIX}/status/{IOT_THING_NAME}/detection"
-                    client.publish(topic, json.dumps(detection_data), 0)
-                    print(f"Published detection to MQTT: {len(detection_data['detections'])} objects")
-                    
-                    # Update last publish time
-                    last_mqtt_publish_time = current_time
+            # Drain everything else that is already queued
+            while len(batch) < MQTT_BATCH_SIZE:
+                try:
+                    batch.append(detection_queue.get_nowait()[1])
+                except queue.Empty:
+                    break
             
-            # Brief pause to prevent CPU overuse
-            time.sleep(0.1)
+            # Publish when the batch is full or the interval has elapsed
+            if batch and (len(batch) >= MQTT_BATCH_SIZE or
+                          time.time() - last_mqtt_publish_time >= MQTT_PUBLISH_INTERVAL):
+                client.publish(topic, orjson.dumps({"batch": batch}, option=orjson.OPT_SERIALIZE_NUMPY), 0)
+                print(f"Published {len(batch)} detections to MQTT: "
+                      f"{sum(len(d['detections']) for d in batch)} objects")
+                batch = []
+                
+                # Update last publish time
+                last_mqtt_publish_time = time.time()
         except Exception as e:
             print(f"Error in MQTT publish thread: {str(e)}")
             time.sleep(1)  # Pause on error before retrying
@@ -329,7 +476,21 @@ os.makedirs("log", exist_ok=True)
 kvs_log_path = os.path.join(KVS_PRODUCER_PATH, 'kvs_log_configuration')
 print(f"Setting KVS log configuration path to: {kvs_log_path}")
 os.environ['KVSSINK_LOG_CONFIG_PATH'] = kvs_log_path
-os.environ['KVSSINK_VERBOSE_LOGGING'] = '1'  # Enable verbose logging
+os.environ['GST_DEBUG'] = '1'  # Errors only; verbose logging costs CPU in every element
+os.environ['GST_PLUGIN_PATH'] = KVS_PRODUCER_PATH  # Lets the in-process pipeline find kvssink
+
+def kvssink_properties():
+    """Return the kvssink element properties shared by both KVS pipelines"""
+    return [
+        f"stream-name={STREAM_NAME}",
+        f"storage-size={KVS_STORAGE_SIZE}",
+        f"max-latency={KVS_MAX_LATENCY}",
+        f"fragment-duration={KVS_FRAGMENT_DURATION}",
+        "key-frame-fragmentation=true"
+    ]
+
+# Matches the KVS producer output lines worth keeping
+KVS_LOG_PATTERN = re.compile(rb"ERROR|WARN")
 
 def start_kvs_producer():
     """Start the Kinesis Video Stream producer as a separate process"""
@@ -340,19 +501,18 @@ def start_kvs_producer():
         os.makedirs("log", exist_ok=True)
         
         # Create .kvs directory directly in the KVS_PRODUCER_PATH
-        kvs_cred_dir = os.path.join(KVS_PRODUCER_PATH, '.kvs')
-        os.makedirs(kvs_cred_dir, exist_ok=True)
+        os.makedirs(KVS_CRED_DIR, exist_ok=True)
         
         # Read credentials from our local .kvs directory
         try:
-            with open(".kvs/credential", "r") as src_file:
-                cred_data = json.load(src_file)
+            with open(".kvs/credential", "rb") as src_file:
+                cred_data = orjson.loads(src_file.read())
                 
                 # Write credentials to the KVS producer directory
-                with open(os.path.join(kvs_cred_dir, "credential"), "w") as dst_file:
-                    json.dump(cred_data, dst_file)
+                with open(os.path.join(KVS_CRED_DIR, "credential"), "wb") as dst_file:
+                    dst_file.write(orjson.dumps(cred_data))
                     
-            print(f"Copied credentials to {kvs_cred_dir}")
+            print(f"Copied credentials to {KVS_CRED_DIR}")
         except Exception as e:
             print(f"Error copying credentials: {str(e)}")
             return None
@@ -375,11 +535,7 @@ def start_kvs_producer():
             "rtspsrc", f"location={rtsp_url}", "latency=0", "buffer-mode=auto", "!",
             "rtph264depay", "!", "h264parse", "!",
             "video/x-h264,stream-format=avc,alignment=au", "!",
-            "kvssink", f"stream-name={STREAM_NAME}",
-            f"storage-size={KVS_STORAGE_SIZE}",
-            f"max-latency={KVS_MAX_LATENCY}",
-            f"fragment-duration={KVS_FRAGMENT_DURATION}",
-            "key-frame-fragmentation=true"
+            "kvssink", *kvssink_properties()
         ]
         
         # Method 2: Use KVS GStreamer sample (fallback)
@@ -400,18 +556,15 @@ def start_kvs_producer():
         env = os.environ.copy()
         env['LD_LIBRARY_PATH'] = f"{KVS_PRODUCER_PATH}:{os.environ.get('LD_LIBRARY_PATH', '')}"
         env['AWS_DEFAULT_REGION'] = AWS_REGION
-        env['GST_DEBUG'] = '2'  # Reduced debug level for better performance
+        env['GST_DEBUG'] = '1'  # Errors only for better performance
         env['GST_PLUGIN_PATH'] = KVS_PRODUCER_PATH  # Set GStreamer plugin path to find kvssink
         
         # Explicitly set AWS credentials in environment variables
-        session = boto3.Session(profile_name=aws_profile)
-        credentials = session.get_credentials()
-        if credentials:
-            frozen_creds = credentials.get_frozen_credentials()
-            env['AWS_ACCESS_KEY_ID'] = frozen_creds.access_key
-            env['AWS_SECRET_ACCESS_KEY'] = frozen_creds.secret_key
-            if frozen_creds.token:
-                env['AWS_SESSION_TOKEN'] = frozen_creds.token
+        if frozen_credentials:
+            env['AWS_ACCESS_KEY_ID'] = frozen_credentials.access_key
+            env['AWS_SECRET_ACCESS_KEY'] = frozen_credentials.secret_key
+            if frozen_credentials.token:
+                env['AWS_SESSION_TOKEN'] = frozen_credentials.token
             print("Added AWS credentials to environment variables")
         
         print(f"Executing KVS command: {' '.join(kvs_command)}")
@@ -422,9 +575,8 @@ def start_kvs_producer():
                 kvs_command,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                text=True,  # Enable text mode for easier reading
-                bufsize=1,   # Line buffered
-                env=env      # Pass environment variables
+                bufsize=65536,  # Read raw bytes in large blocks
+                env=env         # Pass environment variables
             )
             
             print(f"Started KVS producer with PID: {process.pid}")
@@ -432,27 +584,26 @@ def start_kvs_producer():
             # Create threads to read output
             def read_output(pipe, prefix):
                 try:
-                    for line in iter(pipe.readline, ''):
-                        # Only print important messages (errors, warnings)
-                        if "ERROR" in line or "WARN" in line:
-                            print(f"{prefix}: {line.strip()}")
+                    for line in iter(pipe.readline, b''):
+                        # Only decode and print important messages (errors, warnings)
+                        if KVS_LOG_PATTERN.search(line) is None:
+                            continue
+                        message = f"{prefix}: {line.decode('utf-8', 'replace').strip()}"
+                        kvs_log_lines.append(message)
+                        print(message)
                 except Exception as e:
                     print(f"Error in {prefix} reader thread: {str(e)}")
                     
-            stdout_thread = threading.Thread(target=read_output, args=(process.stdout, "KVS OUT"))
-            stderr_thread = threading.Thread(target=read_output, args=(process.stderr, "KVS ERR"))
-            stdout_thread.daemon = True
-            stderr_thread.daemon = True
-            stdout_thread.start()
-            stderr_thread.start()
+            executor.submit(read_output, process.stdout, "KVS OUT")
+            executor.submit(read_output, process.stderr, "KVS ERR")
             
             # Check if process is running
             time.sleep(1)
             if process.poll() is not None:
                 print(f"KVS process exited immediately with code: {process.returncode}")
                 stdout, stderr = process.communicate()
-                print(f"KVS stdout: {stdout}")
-                print(f"KVS stderr: {stderr}")
+                print(f"KVS stdout: {stdout.decode('utf-8', 'replace')}")
+                print(f"KVS stderr: {stderr.decode('utf-8', 'replace')}")
                 
                 # Try Method 2 if Method 1 fails (KVS GStreamer sample)
                 print("Method 1 failed. Trying Method 2 with KVS GStreamer sample...")
@@ -460,19 +611,14 @@ def start_kvs_producer():
                     kvs_sample_command,
                     stdout=subprocess.PIPE,
                     stderr=subprocess.PIPE,
-                    text=True,
-                    bufsize=1,
+                    bufsize=65536,
                     env=env,
                     cwd=KVS_PRODUCER_PATH
                 )
                 
                 # Set up output readers for Method 2
-                stdout_thread = threading.Thread(target=read_output, args=(process.stdout, "KVS OUT"))
-                stderr_thread = threading.Thread(target=read_output, args=(process.stderr, "KVS ERR"))
-                stdout_thread.daemon = True
-                stderr_thread.daemon = True
-                stdout_thread.start()
-                stderr_thread.start()
+                executor.submit(read_output, process.stdout, "KVS OUT")
+                executor.submit(read_output, process.stderr, "KVS ERR")
                 
                 # Check if Method 2 is running
                 time.sleep(1)
@@ -489,36 +635,106 @@ def start_kvs_producer():
         traceback.print_exc()
         return None
 
-def capture_video():
+def build_capture_pipeline(url, with_kvs=False):
+    """Build a GStreamer appsink pipeline that decodes the RTSP stream to BGR frames"""
+    if os.path.exists("/etc/nv_tegra_release"):
+        # Jetson: hardware decoder, then convert out of NVMM memory
+        decode = "nvv4l2decoder ! nvvidconv ! video/x-raw,format=BGRx ! videoconvert"
+    else:
+        decode = "avdec_h264 ! videoconvert"
+    # Keep at most two decoded frames and drop older ones instead of queueing
+    appsink = f"{decode} ! video/x-raw,format=BGR ! appsink drop=true max-buffers=2 sync=false"
+    
+    if not with_kvs:
+        return f"rtspsrc location={url} latency=0 ! rtph264depay ! h264parse ! {appsink}"
+    
+    # One RTSP connection, tee'd into kvssink (no decode) and the decoder branch
+    return (f"rtspsrc location={url} latency=0 ! rtph264depay ! tee name=t "
+            "t. ! queue ! h264parse ! video/x-h264,stream-format=avc,alignment=au ! "
+            f"kvssink {' '.join(kvssink_properties())} "
+            f"t. ! queue ! h264parse ! {appsink}")
+
+def open_video_source():
+    """Open the video source, returns (capture, whether kvssink runs inside it)"""
+    print(f"Opening video source: {rtsp_url}")
+    # Stream to KVS and YOLO from a single RTSP connection when possible
+    cap = cv2.VideoCapture(build_capture_pipeline(rtsp_url, with_kvs=True), cv2.CAP_GSTREAMER)
+    if cap.isOpened():
+        print(f"Streaming to KVS from the capture pipeline: {', '.join(kvssink_properties())}")
+        return cap, True
+    print("Shared KVS pipeline unavailable, KVS will use a separate producer")
+    
+    # Try the GStreamer RTSP pipeline first, then OpenCV's default backend,
+    # and fall back to local camera if both fail
+    cap = cv2.VideoCapture(build_capture_pipeline(rtsp_url), cv2.CAP_GSTREAMER)
+    if not cap.isOpened():
+        print("GStreamer pipeline unavailable, opening RTSP stream with default backend")
+        cap = cv2.VideoCapture(rtsp_url)
+    if not cap.isOpened():
+        print(f"Failed to open RTSP stream at {rtsp_url}, falling back to local camera")
+        cap = cv2.VideoCapture(VIDEO_DEVICE)
+        
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
+    cap.set(cv2.CAP_PROP_FPS, FPS)
+    
+    if not cap.isOpened():
+        print("Failed to open video device")
+        sys.exit(1)
+    return cap, False
+
+def frame_hash(frame):
+    """Return a 64-bit average hash of the frame (8x8 grayscale, thresholded at its mean)"""
+    small = cv2.resize(frame, (8, 8), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return int.from_bytes(np.packbits(gray > gray.mean()).tobytes(), 'little')
+
+def render_overlay(layer, mask, time_prefix, cloud_text):
+    """Render the static overlay text into layer and mask, returns x of the millisecond digits"""
+    layer[:] = 0
+    mask[:] = 0
+    time_text = f"Time: {time_prefix}."
+    # Draw the same text into the colour layer and the copy mask
+    if cloud_text:
+        for img, color in ((layer, (0, 0, 255)), (mask, 255)):
+            cv2.putText(img, cloud_text, (10, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
+    for img, color in ((layer, (255, 255, 255)), (mask, 255)):
+        cv2.putText(img, time_text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+    (width, _), _ = cv2.getTextSize(time_text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+    return 10 + width
+
+def capture_video(cap):
     """Capture video from camera and feed both to YOLO and display"""
     global running
     
     try:
-        print(f"Opening video source: {rtsp_url}")
-        # Try RTSP stream first, fall back to local camera if that fails
-        cap = cv2.VideoCapture(rtsp_url)
-        if not cap.isOpened():
-            print(f"Failed to open RTSP stream at {rtsp_url}, falling back to local camera")
-            cap = cv2.VideoCapture(VIDEO_DEVICE)
-            
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
-        cap.set(cv2.CAP_PROP_FPS, FPS)
-        
-        if not cap.isOpened():
-            print("Failed to open video device")
-            sys.exit(1)
-        
         print("Video capture started")
         frame_count = 0
         start_time = time.time()
+        frame_buf = np.empty((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8)
+        display_buf = None
+        # Clock text only changes once a second, so format it once per second
+        last_sec = 0
+        time_prefix = ""
+        # Pre-rendered overlay text, only redrawn when the text changes
+        overlay_layer = overlay_mask = None
+        overlay_key = None
+        ms_x = 0
+        next_yolo_time = 0
+        # Hash of the last frame sent to YOLO, to skip visually identical frames
+        last_hash = None
+        last_yolo_time = 0
         
         while running:
-            ret, frame = cap.read()
+            # Decode straight into the pre-allocated frame buffer
+            ret, frame = cap.read(frame_buf)
             if not ret:
                 print("Failed to read frame")
                 time.sleep(0.1)
                 continue
+            if frame is not frame_buf:
+                # Source resolution differs from FRAME_WIDTH x FRAME_HEIGHT, keep OpenCV's buffer
+                frame_buf = frame
             
             timestamp = time.time()
             frame_count += 1
@@ -529,25 +745,49 @@ def capture_video():
                 fps = frame_count / elapsed
                 print(f"Video capture running at {fps:.2f} FPS")
             
-            # Put frame in queue for YOLO processing
-            # Only if queue is not full to prevent memory buildup
-            if not frame_queue.full():
-                frame_queue.put((frame.copy(), timestamp))
+            # Only hand frames to YOLO at the processing interval, downscaled
+            # into a free ring slot at the model's input size
+            if timestamp >= next_yolo_time:
+                next_yolo_time = max(next_yolo_time + YOLO_PROCESSING_INTERVAL, timestamp)
+                
+                # Skip frames that look the same as the last one YOLO saw; the
+                # overlay keeps showing latest_detection in the meantime
+                h = frame_hash(frame)
+                unchanged = (last_hash is not None and
+                             bin(h ^ last_hash).count('1') <= FRAME_HASH_THRESHOLD and
+                             timestamp - last_yolo_time < FRAME_HASH_MAX_SKIP)
+                if not unchanged:
+                    last_hash = h
+                    last_yolo_time = timestamp
+                    try:
+                        idx = free_slots.get_nowait()
+                        cv2.resize(frame, (YOLO_INPUT_SIZE[1], YOLO_INPUT_SIZE[0]), dst=frame_ring[idx])
+                        scale = (frame.shape[1] / YOLO_INPUT_SIZE[1], frame.shape[0] / YOLO_INPUT_SIZE[0])
+                        replaced = frame_slot.put((idx, timestamp, scale))
+                        if replaced:
+                            # YOLO never saw the older frame, recycle its slot
+                            free_slots.put(replaced[0])
+                    except queue.Empty:
+                        pass
             
             # Display frame with detection overlay (if enabled)
             if display_video:
-                display_frame = frame.copy()
+                if display_buf is None or display_buf.shape != frame.shape:
+                    display_buf = np.empty_like(frame)
+                    overlay_layer = np.zeros((OVERLAY_HEIGHT, frame.shape[1], 3), dtype=np.uint8)
+                    overlay_mask = np.zeros((OVERLAY_HEIGHT, frame.shape[1]), dtype=np.uint8)
+                    overlay_key = None
+                np.copyto(display_buf, frame)
+                display_frame = display_buf
                 
                 # Add detection boxes if available
-                if not detection_queue.empty():
-                    # Peek at the detection data without removing it
-                    # This allows the MQTT thread to still get the data
-                    detection_data = list(detection_queue.queue)[0][1]
-                    
+                with latest_detection["lock"]:
+                    detection_data = latest_detection["data"]
+                if detection_data:
                     # Draw bounding boxes for edge detections
                     for det in detection_data.get("detections", []):
                         box = det.get("box")
-                        if box:
+                        if box is not None:
                             x1, y1, x2, y2 = map(int, box)
                             confidence = det.get("confidence", 0)
                             class_name = det.get("class", "unknown")
@@ -560,24 +800,32 @@ def capture_video():
                             cv2.putText(display_frame, label, (x1, y1 - 10),
                                         cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
                 
-                # Show any cloud commands
-                for ts, cmd in list(cloud_commands.items()):
-                    # Display recent commands (last 3 seconds)
-                    if time.time() - ts < 3:
-                        command = cmd.get("command", "")
-                        reason = cmd.get("reason", "")
-                        
-                        # Display command on frame (red for stop commands)
-                        if command == "stop":
-                            cv2.putText(display_frame, f"CLOUD: {command} - {reason}", 
-                                       (10, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-                    else:
-                        # Remove old commands
-                        cloud_commands.pop(ts, None)
+                # Remove old commands, then show recent ones (last 3 seconds)
+                while cloud_commands and timestamp - cloud_commands[0][0] > 3:
+                    cloud_commands.popleft()
+                cloud_text = ""
+                # Snapshot, the IoT callback thread may append while we draw
+                for ts, cmd in tuple(cloud_commands):
+                    command = cmd.get("command", "")
+                    reason = cmd.get("reason", "")
+                    
+                    # Display command on frame (red for stop commands)
+                    if command == "stop":
+                        cloud_text = f"CLOUD: {command} - {reason}"
                 
                 # Display timestamp and FPS
-                cv2.putText(display_frame, f"Time: {datetime.fromtimestamp(timestamp).strftime('%H:%M:%S.%f')[:-3]}", 
-                           (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+                sec = int(timestamp)
+                if sec != last_sec:
+                    time_prefix = time.strftime('%H:%M:%S', time.localtime(sec))
+                    last_sec = sec
+                
+                # Re-render the overlay text only when it changes, then copy it in
+                if (time_prefix, cloud_text) != overlay_key:
+                    ms_x = render_overlay(overlay_layer, overlay_mask, time_prefix, cloud_text)
+                    overlay_key = (time_prefix, cloud_text)
+                cv2.copyTo(overlay_layer, overlay_mask, display_frame[:OVERLAY_HEIGHT])
+                cv2.putText(display_frame, f"{int((timestamp - sec) * 1000):03d}",
+                           (ms_x, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
                 
                 # Show the frame
                 cv2.imshow("ADRVE Edge Device", display_frame)
@@ -601,7 +849,7 @@ def capture_video():
 # ==================== MAIN FUNCTION ====================
 def main():
     """Main function"""
-    global running, rtsp_url, display_video
+    global running, rtsp_url, display_video, executor
     
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='ADRVE Edge Device Script - Optimized for Smooth KVS Streaming')
@@ -617,6 +865,7 @@ def main():
     rtsp_url = args.rtsp_url
     display_video = not args.no_display
     
+    kvs_process = None
     try:
         print("Starting ADRVE Edge Device - Optimized for Smooth KVS Streaming (Final Version)...")
         print(f"RTSP URL: {rtsp_url}")
@@ -629,36 +878,39 @@ def main():
         
         # Initialize YOLO model
         model = initialize_yolo()
+        warmup_yolo(model)
         
         # Initialize IoT
         iot_client = initialize_iot()
         if iot_client:
             setup_iot_subscriptions(iot_client)
         
-        # Start KVS producer
-        kvs_process = start_kvs_producer()
-        if kvs_process is None:
-            print("Failed to start KVS producer. Exiting.")
-            return
+        # Open the video source, which also streams to KVS when kvssink is available
+        cap, kvs_in_pipeline = open_video_source()
+        
+        # YOLO + MQTT + the two KVS output readers
+        executor = ThreadPoolExecutor(max_workers=4)
         
-        # Start threads
-        threads = []
+        # Otherwise start a separate KVS producer
+        if not kvs_in_pipeline:
+            kvs_process = start_kvs_producer()
+            if kvs_process is None:
+                print("Failed to start KVS producer. Exiting.")
+                cap.release()
+                return
         
-        # Start YOLO detection thread
-        yolo_thread = threading.Thread(target=yolo_detection_thread, args=(model,))
-        yolo_thread.daemon = True
-        yolo_thread.start()
-        threads.append(yolo_thread)
+        # Start worker tasks
+        futures = []
         
-        # Start MQTT publish thread (if IoT client is initialized)
+        # Start YOLO detection task
+        futures.append(executor.submit(yolo_detection_thread, model))
+        
+        # Start MQTT publish task (if IoT client is initialized)
         if iot_client:
-            mqtt_thread = threading.Thread(target=mqtt_publish_thread, args=(iot_client,))
-            mqtt_thread.daemon = True
-            mqtt_thread.start()
-            threads.append(mqtt_thread)
+            futures.append(executor.submit(mqtt_publish_thread, iot_client))
         
         # Start video capture (this will block until exit)
-        capture_video()
+        capture_video(cap)
         
         # Cleanup
         running = False
@@ -670,15 +922,18 @@ def main():
         if iot_client:
             iot_client.disconnect()
         
-        # Wait for threads to finish
-        for thread in threads:
-            thread.join(timeout=2.0)
+        # Wait for worker tasks to finish
+        wait(futures, timeout=2.0)
+        executor.shutdown(wait=False)
         
         print("Shutdown complete")
     
     except KeyboardInterrupt:
         print("Interrupted by user")
         running = False
+        # Pool workers are not daemon threads; closing the producer ends the output readers
+        if kvs_process:
+            kvs_process.terminate()
     except Exception as e:
         print(f"Error in main function: {str(e)}")
         traceback.print_exc()
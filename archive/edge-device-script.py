@@ -11,6 +11,7 @@ This script integrates:
 Requirements:
 - Python 3.8+
 - ultralytics package (pip install ultralytics)
+- PyTorch (installed with ultralytics)
 - boto3 (pip install boto3)
 - AWSIoTPythonSDK (pip install AWSIoTPythonSDK)
 - opencv-python (pip install opencv-python)
@@ -32,9 +33,13 @@ import threading
 import queue
 import cv2
 import numpy as np
+import torch
 import boto3
 import subprocess
 import argparse
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from ultralytics import YOLO
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
@@ -52,16 +57,33 @@ IOT_TOPIC_PREFIX = "adrve"
 # Video Configuration
 STREAM_NAME = "adrve-video-stream"
 VIDEO_DEVICE = 0  # Usually 0 for primary webcam
+RTMP_URL = "rtmp://10.31.50.195:1935/live/test"  # Preferred capture source, ahead of VIDEO_DEVICE
 FRAME_WIDTH = 1280
 FRAME_HEIGHT = 720
 FPS = 15
+FRAME_SLOTS = 3  # Shared-memory frame buffers: one being filled, one queued, one in YOLO
+DISPLAY_FPS = 15  # Cap on how often frames are decoded just for the preview window
 KVS_PRODUCER_PATH = "/mnt/c/code/ADRVE/adrve-edge/amazon-kinesis-video-streams-producer-sdk-cpp/build"
+# Hardware H.264 decoders tried in order for RTMP capture when OpenCV is built with GStreamer,
+# each followed by the conversion it needs to reach BGR
+GST_H264_DECODERS = [
+    "nvv4l2decoder ! nvvidconv ! video/x-raw,format=BGRx ! videoconvert",  # Jetson
+    "nvh264dec ! videoconvert",  # NVIDIA desktop GPUs
+]
+OPENCV_HAS_GSTREAMER = any(
+    line.strip().startswith("GStreamer:") and "YES" in line
+    for line in cv2.getBuildInformation().splitlines()
+)
 
 # YOLO Configuration
 YOLO_MODEL_PATH = "yolo11n.pt"  # Will be downloaded if not present
+YOLO_INPUT_SIZE = 448  # Model input side; exports are built for this fixed shape
+# Export names carry their settings, as other scripts export the same weights with different shapes
+YOLO_ENGINE_PATH = f"yolo11n_{YOLO_INPUT_SIZE}.engine"  # TensorRT FP16 export of YOLO_MODEL_PATH, created on first run on CUDA devices
+YOLO_OPENVINO_PATH = f"yolo11n_{YOLO_INPUT_SIZE}_int8_openvino_model"  # OpenVINO INT8 export of YOLO_MODEL_PATH, created on first run on CPU hosts
 CONFIDENCE_THRESHOLD = 0.3
 # Classes we're particularly interested in (subset of COCO)
-CLASSES_OF_INTEREST = [
+CLASSES_OF_INTEREST = frozenset([
     0,   # person
     1,   # bicycle
     2,   # car
@@ -72,13 +94,23 @@ CLASSES_OF_INTEREST = [
     16,  # dog
     17,  # cat
     18,  # horse
-]
+])
 
 # ==================== GLOBAL VARIABLES ====================
-# Frame queue for YOLO processing
-frame_queue = queue.Queue(maxsize=10)
-# Detection results queue
-detection_queue = queue.Queue()
+# YOLO runs in its own process so it does not contend with capture and display for the GIL;
+# the process-shared objects below are created in main()
+# Slot index (-1 for none) and timestamp of the newest frame for YOLO, replaced rather than
+# queued behind; both are guarded by latest_slot's lock and frame_ready is set on each handoff
+latest_slot = None
+latest_time = None
+frame_ready = None
+# Indices of shared-memory frame slots that YOLO has finished with
+free_slots = None
+# Newest detection result for the display, replaced rather than queued behind
+detection_queue = None
+# Shared memory holding FRAME_SLOTS frames, and a numpy view of each slot
+frame_shm = None
+frame_slots = []
 # Flag to control threads
 running = True
 # Current commands from cloud
@@ -147,6 +179,24 @@ def initialize_yolo():
     """Initialize and return YOLO model"""
     print("Initializing YOLOv11 model...")
     try:
+        # Prefer a TensorRT FP16 engine on CUDA devices and an INT8 OpenVINO model on CPU,
+        # exported once and reused; fall back to the PyTorch weights if the export fails
+        if torch.cuda.is_available():
+            model_path, export_format, export_args = YOLO_ENGINE_PATH, "engine", {"half": True, "workspace": 4, "device": 0, "imgsz": YOLO_INPUT_SIZE}
+        else:
+            model_path, export_format, export_args = YOLO_OPENVINO_PATH, "openvino", {"int8": True, "data": "coco128.yaml", "imgsz": YOLO_INPUT_SIZE}
+        try:
+            if not os.path.exists(model_path):
+                print(f"Exporting {YOLO_MODEL_PATH} to {export_format}, this can take several minutes...")
+                # Ultralytics names exports after the weights; keep this one under a name that
+                # records its export settings so other scripts' exports are never loaded by mistake
+                os.replace(YOLO(YOLO_MODEL_PATH).export(format=export_format, **export_args), model_path)
+            model = YOLO(model_path, task="detect")
+            print(f"YOLO {export_format} model loaded successfully: {model_path}")
+            return model
+        except Exception as e:
+            print(f"YOLO {export_format} model unavailable: {str(e)}")
+        
         model = YOLO(YOLO_MODEL_PATH)
         print("YOLO model loaded successfully")
         return model
@@ -154,50 +204,92 @@ def initialize_yolo():
         print(f"Failed to load YOLO model: {str(e)}")
         sys.exit(1)
 
-def yolo_detection_thread(model):
-    """Thread to run YOLO detection on frames"""
-    print("Starting YOLO detection thread")
-    while running:
+def slot_views(shm):
+    """Return a numpy frame view of each slot in the shared frame buffer"""
+    shape = (FRAME_HEIGHT, FRAME_WIDTH, 3)
+    slot_bytes = FRAME_HEIGHT * FRAME_WIDTH * 3
+    return [np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=i * slot_bytes) for i in range(FRAME_SLOTS)]
+
+def postprocess_detections(results, timestamp, class_names, detection_queue):
+    """Convert YOLO results to a detection result and queue it for display"""
+    try:
+        r = results[0]
+        xyxy = r.boxes.xyxy.cpu().numpy()
+        conf = r.boxes.conf.cpu().numpy()
+        cls = r.boxes.cls.cpu().numpy().astype(np.int32)
+        
+        detections = [
+            {
+                "box": box,
+                "class": class_names[class_id],
+                "class_id": class_id,
+                "confidence": confidence
+            }
+            for box, confidence, class_id in zip(xyxy.tolist(), conf.tolist(), cls.tolist())
+        ]
+        
+        # Put results in the detection queue, replacing a result the display has not drawn yet
+        detection_result = {
+            "timestamp": timestamp,
+            "detections": detections,
+            "source": "edge"
+        }
         try:
-            if not frame_queue.empty():
-                frame_data = frame_queue.get()
-                if frame_data is None:
-                    continue
-                
-                frame, timestamp = frame_data
-                results = model(frame, conf=CONFIDENCE_THRESHOLD)
-                
-                detections = []
-                for r in results:
-                    boxes = r.boxes
-                    for box in boxes:
-                        x1, y1, x2, y2 = box.xyxy[0]
-                        conf = float(box.conf[0])
-                        cls = int(box.cls[0])
-                        
-                        # If the class is in our list of interest, and confidence exceeds threshold
-                        if cls in CLASSES_OF_INTEREST and conf > CONFIDENCE_THRESHOLD:
-                            class_name = model.names[cls]
-                            detection = {
-                                "box": [float(x1), float(y1), float(x2), float(y2)],
-                                "class": class_name,
-                                "class_id": cls,
-                                "confidence": conf
-                            }
-                            detections.append(detection)
-                
-                # Put results in the detection queue
-                detection_result = {
-                    "timestamp": timestamp,
-                    "detections": detections,
-                    "source": "edge"
-                }
-                detection_queue.put((frame, detection_result))
-            else:
-                time.sleep(0.01)  # Brief pause if no frames
+            detection_queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            detection_queue.put_nowait(detection_result)
+        except queue.Full:
+            pass
+    except Exception as e:
+        print(f"Error post-processing detections: {str(e)}")
+
+def yolo_worker(shm_name, latest_slot, latest_time, frame_ready, free_slots, detection_queue, stop_event):
+    """Process to run YOLO detection on frames handed over in shared memory"""
+    model = initialize_yolo()
+    # Resolved once: Ultralytics wants a class list, and a tuple is the cheapest id-to-name lookup
+    classes = sorted(CLASSES_OF_INTEREST)
+    class_names = tuple(model.names[i] for i in range(len(model.names)))
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slots = slot_views(shm)
+    # Post-processing runs beside the next inference; one thread keeps results in frame order
+    post_pool = ThreadPoolExecutor(max_workers=1)
+    
+    print("Starting YOLO detection worker")
+    while not stop_event.is_set():
+        try:
+            if not frame_ready.wait(timeout=0.5):
+                continue
+            # Take the newest frame's slot; capture hands over a new one when it next sets the event
+            with latest_slot.get_lock():
+                frame_ready.clear()
+                idx = latest_slot.value
+                timestamp = latest_time.value
+                latest_slot.value = -1
+            if idx < 0:
+                continue
+            
+            try:
+                # Class and confidence filtering happen inside the model's NMS
+                results = model(slots[idx], imgsz=YOLO_INPUT_SIZE, conf=CONFIDENCE_THRESHOLD, classes=classes, verbose=False)
+            finally:
+                # Inference no longer needs the pixels, or failed, so capture can refill the slot
+                free_slots.put(idx)
+            
+            post_pool.submit(postprocess_detections, results, timestamp, class_names, detection_queue)
         except Exception as e:
-            print(f"Error in YOLO detection thread: {str(e)}")
+            print(f"Error in YOLO detection worker: {str(e)}")
             time.sleep(1)  # Pause on error before retrying
+    
+    # Drop every view of the shared buffer before closing it
+    post_pool.shutdown(wait=True)
+    slots = results = None
+    try:
+        shm.close()
+    except BufferError:
+        # The predictor can still hold a view of the last frame; the mapping goes with the process
+        print("Shared frame buffer still in use, leaving it to process exit")
 
 # ==================== AWS IoT ====================
 def initialize_iot():
@@ -471,12 +563,29 @@ def capture_video():
     global running
     try:
         print(f"Opening video device {VIDEO_DEVICE}")
-        # Try RTMP stream first, fall back to local camera if that fails
-        cap = cv2.VideoCapture("rtmp://10.31.50.195:1935/live/test")
+        # Try RTMP stream first, decoded in hardware through GStreamer when available, then in software
+        # through FFmpeg; fall back to local camera if that fails
+        cap = None
+        if OPENCV_HAS_GSTREAMER:
+            for decoder in GST_H264_DECODERS:
+                pipeline = (
+                    f"rtmpsrc location={RTMP_URL} ! flvdemux ! h264parse ! {decoder} ! "
+                    "video/x-raw,format=BGR ! appsink drop=true max-buffers=1 sync=false"
+                )
+                cap = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
+                if cap.isOpened():
+                    print(f"Decoding RTMP stream with {decoder.split()[0]}")
+                    break
+        if cap is None or not cap.isOpened():
+            # FFmpeg low-latency flags must be set before the stream is opened
+            os.environ.setdefault("OPENCV_FFMPEG_CAPTURE_OPTIONS", "fflags;nobuffer|flags;low_delay|max_delay;0")
+            cap = cv2.VideoCapture(RTMP_URL, cv2.CAP_FFMPEG)
         if not cap.isOpened():
             print("Failed to open RTMP stream, falling back to local camera")
-            cap = cv2.VideoCapture(VIDEO_DEVICE)
-            
+            cap = cv2.VideoCapture(VIDEO_DEVICE, cv2.CAP_V4L2)
+        
+        # Keep only the newest frame buffered so YOLO and the display see the present, not a backlog
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
         cap.set(cv2.CAP_PROP_FRAME_WIDTH, FRAME_WIDTH)
         cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
         cap.set(cv2.CAP_PROP_FPS, FPS)
@@ -486,39 +595,73 @@ def capture_video():
             sys.exit(1)
         
         print("Video capture started")
-        last_fps_time = time.time()
+        last_fps_time = time.monotonic()
+        last_display_time = 0
         frame_count = 0
+        # Overlay clock text, formatted only when the second changes
+        clock_second = None
+        clock_text = ""
         
         while running:
-            ret, frame = cap.read()
+            # Advance the stream without decoding; decode only frames that YOLO or the display will use
+            ret = cap.grab()
             if not ret:
                 print("Failed to read frame")
                 time.sleep(0.1)
                 continue
             
+            # Wall-clock timestamp for detections and the overlay, monotonic clock for intervals
             timestamp = time.time()
+            now = time.monotonic()
             frame_count += 1
             
             # Calculate FPS every second
-            if time.time() - last_fps_time > 1:
-                fps = frame_count / (time.time() - last_fps_time)
+            if now - last_fps_time > 1:
+                fps = frame_count / (now - last_fps_time)
                 print(f"Capture FPS: {fps:.2f}")
                 frame_count = 0
-                last_fps_time = time.time()
+                last_fps_time = now
             
-            # Put frame in queue for YOLO processing
-            if not frame_queue.full():
-                frame_queue.put((frame.copy(), timestamp))
+            need_yolo = latest_slot.value < 0
+            need_display = now - last_display_time >= 1.0 / DISPLAY_FPS
+            if not (need_yolo or need_display):
+                continue
+            ret, frame = cap.retrieve()
+            if not ret:
+                continue
+            if frame.shape != frame_slots[0].shape:
+                # Shared-memory slots hold frames at the configured resolution
+                frame = cv2.resize(frame, (FRAME_WIDTH, FRAME_HEIGHT))
+            
+            # Hand the newest decoded frame to YOLO, reusing the slot of a stale frame it has not
+            # picked up yet, otherwise a free one
+            with latest_slot.get_lock():
+                idx = latest_slot.value
+                latest_slot.value = -1
+            if idx < 0:
+                try:
+                    idx = free_slots.get_nowait()
+                except queue.Empty:
+                    idx = -1
+            if idx >= 0:
+                np.copyto(frame_slots[idx], frame)
+                with latest_slot.get_lock():
+                    latest_slot.value = idx
+                    latest_time.value = timestamp
+                frame_ready.set()
+            if not need_display:
+                continue
+            last_display_time = now
             
             # In POC, we assume the KVS producer captures from the same video device
             # In production, we would send the frame to the KVS producer
             
-            # Display frame with detection overlay (if available)
-            display_frame = frame.copy()
+            # Display frame with detection overlay (if available), drawn in place:
+            # YOLO works on its own copy in shared memory, so nothing else reads this frame
             
             # Add detection boxes if available
             if not detection_queue.empty():
-                _, detection_data = detection_queue.get()
+                detection_data = detection_queue.get()
                 
                 # Draw bounding boxes for edge detections
                 for det in detection_data.get("detections", []):
@@ -529,34 +672,38 @@ def capture_video():
                         class_name = det.get("class", "unknown")
                         
                         # Draw box (green for edge detections)
-                        cv2.rectangle(display_frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+                        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
                         
                         # Add label
                         label = f"{class_name}: {confidence:.2f}"
-                        cv2.putText(display_frame, label, (x1, y1 - 10),
+                        cv2.putText(frame, label, (x1, y1 - 10),
                                     cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
             
             # Show any cloud commands
             for ts, cmd in list(cloud_commands.items()):
                 # Display recent commands (last 3 seconds)
-                if time.time() - ts < 3:
+                if timestamp - ts < 3:
                     command = cmd.get("command", "")
                     reason = cmd.get("reason", "")
                     
                     # Display command on frame (red for stop commands)
                     if command == "stop":
-                        cv2.putText(display_frame, f"CLOUD: {command} - {reason}", 
+                        cv2.putText(frame, f"CLOUD: {command} - {reason}", 
                                    (10, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
                 else:
                     # Remove old commands
                     cloud_commands.pop(ts, None)
             
             # Display timestamp
-            cv2.putText(display_frame, f"Time: {datetime.fromtimestamp(timestamp).strftime('%H:%M:%S.%f')[:-3]}", 
+            second = int(timestamp)
+            if second != clock_second:
+                clock_text = datetime.fromtimestamp(second).strftime('%H:%M:%S')
+                clock_second = second
+            cv2.putText(frame, f"Time: {clock_text}.{int((timestamp % 1) * 1000):03d}", 
                        (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
             
             # Show the frame
-            cv2.imshow("ADRVE Edge Device", display_frame)
+            cv2.imshow("ADRVE Edge Device", frame)
             
             # Check for exit key
             key = cv2.waitKey(1) & 0xFF
@@ -576,7 +723,7 @@ def capture_video():
 # ==================== MAIN FUNCTION ====================
 def main():
     """Main function"""
-    global running
+    global running, latest_slot, latest_time, frame_ready, free_slots, detection_queue, frame_shm, frame_slots
     
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='ADRVE Edge Device Script')
@@ -592,13 +739,27 @@ def main():
             print("Failed to set up AWS credentials. Exiting.")
             return
         
-        # Initialize YOLO model
-        model = initialize_yolo()
-        
-        # Start YOLO detection thread
-        yolo_thread = threading.Thread(target=yolo_detection_thread, args=(model,))
-        yolo_thread.daemon = True
-        yolo_thread.start()
+        # Shared frame buffers and queues for the YOLO worker process; spawn so the worker
+        # starts with a clean CUDA context
+        ctx = multiprocessing.get_context("spawn")
+        frame_shm = shared_memory.SharedMemory(create=True, size=FRAME_HEIGHT * FRAME_WIDTH * 3 * FRAME_SLOTS)
+        frame_slots = slot_views(frame_shm)
+        latest_slot = ctx.Value('i', -1)
+        latest_time = ctx.Value('d', 0.0, lock=False)
+        frame_ready = ctx.Event()
+        free_slots = ctx.Queue()
+        for i in range(FRAME_SLOTS):
+            free_slots.put(i)
+        detection_queue = ctx.Queue(maxsize=1)
+        yolo_stop = ctx.Event()
+        
+        # Start YOLO detection worker, which loads the model itself
+        yolo_process = ctx.Process(
+            target=yolo_worker,
+            args=(frame_shm.name, latest_slot, latest_time, frame_ready, free_slots, detection_queue, yolo_stop)
+        )
+        yolo_process.daemon = True
+        yolo_process.start()
         
         # Initialize IoT
         iot_client = initialize_iot()
@@ -621,6 +782,15 @@ def main():
         if iot_client:
             iot_client.disconnect()
         
+        # Stop the YOLO worker before releasing the shared frame buffers
+        yolo_stop.set()
+        yolo_process.join(timeout=5.0)
+        if yolo_process.is_alive():
+            yolo_process.terminate()
+        frame_slots = []
+        frame_shm.close()
+        frame_shm.unlink()
+        
         print("Shutdown complete")
     
     except KeyboardInterrupt:
@@ -10,9 +10,11 @@ This script integrates:
 Requirements:
 - Python 3.8+
 - ultralytics package (pip install ultralytics)
+- TensorRT (optional, for the exported .engine model on CUDA devices)
 - boto3 (pip install boto3)
 - AWSIoTPythonSDK (pip install AWSIoTPythonSDK)
 - opencv-python (pip install opencv-python)
+- numba (pip install numba)
 - Amazon Kinesis Video Streams Producer SDK (requires separate installation)
 
 Before running, configure AWS credentials and update the CONFIG section.
@@ -33,11 +35,13 @@ import threading
 import queue
 import cv2
 import numpy as np
+import torch
 import boto3
 import subprocess
 import argparse
 import traceback
 from datetime import datetime
+from numba import njit
 from ultralytics import YOLO
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 
@@ -68,7 +72,12 @@ KVS_MAX_LATENCY = 0          # Minimize latency
 
 # YOLO Configuration
 YOLO_MODEL_PATH = "yolo11n.pt"  # Will be downloaded if not present
+YOLO_ENGINE_INT8 = False  # INT8 needs a calibration dataset; FP16 otherwise
+YOLO_CALIBRATION_DATA = "coco128.yaml"  # INT8 calibration dataset; the full coco.yaml is a ~20 GB download
 CONFIDENCE_THRESHOLD = 0.3
+YOLO_BATCH_SIZE = 4  # Queued frames run through one batched forward pass; lower if VRAM runs out
+# Named after its export settings, as other scripts export the same weights with different shapes
+YOLO_ENGINE_PATH = f"yolo11n_640_dynamic_b{YOLO_BATCH_SIZE}_{'int8' if YOLO_ENGINE_INT8 else 'fp16'}.engine"  # TensorRT engine, exported from YOLO_MODEL_PATH on first run
 # Classes we're particularly interested in (subset of COCO)
 CLASSES_OF_INTEREST = [
     0,   # person
@@ -82,6 +91,9 @@ CLASSES_OF_INTEREST = [
     17,  # cat
     18,  # horse
 ]
+# Lookup table over COCO class ids for the compiled detection filter
+COI_MASK = np.zeros(256, dtype=np.bool_)
+COI_MASK[CLASSES_OF_INTEREST] = True
 
 # Performance Configuration
 YOLO_PROCESSING_INTERVAL = 0.2  # Process frames every 0.2 seconds (5 FPS for YOLO)
@@ -164,17 +176,56 @@ def setup_aws_credentials(profile_name):
         return False
 
 # ==================== YOLO MODEL ====================
+def export_yolo_engine():
+    """Export the YOLO model to a TensorRT engine"""
+    print(f"Exporting {YOLO_MODEL_PATH} to TensorRT ({'INT8' if YOLO_ENGINE_INT8 else 'FP16'}), this can take several minutes...")
+    # Dynamic batch up to YOLO_BATCH_SIZE so partial batches run on the same engine
+    export_args = {"format": "engine", "half": True, "dynamic": True, "batch": YOLO_BATCH_SIZE, "workspace": 4}
+    if YOLO_ENGINE_INT8:
+        export_args.update(int8=True, data=YOLO_CALIBRATION_DATA)
+    # Ultralytics names exports after the weights; keep this one under a name that
+    # records its export settings so other scripts' exports are never loaded by mistake
+    os.replace(YOLO(YOLO_MODEL_PATH).export(**export_args), YOLO_ENGINE_PATH)
+    return YOLO_ENGINE_PATH
+
 def initialize_yolo():
     """Initialize and return YOLO model"""
     print("Initializing YOLOv11 model...")
     try:
-        model = YOLO(YOLO_MODEL_PATH)
-        print("YOLO model loaded successfully")
+        engine_path = YOLO_ENGINE_PATH
+        if not os.path.exists(engine_path) and torch.cuda.is_available():
+            try:
+                engine_path = export_yolo_engine()
+            except Exception as e:
+                print(f"TensorRT export failed, using PyTorch model: {str(e)}")
+        
+        if os.path.exists(engine_path):
+            model = YOLO(engine_path, task="detect")
+            print(f"YOLO TensorRT engine loaded successfully: {engine_path}")
+        else:
+            model = YOLO(YOLO_MODEL_PATH)
+            print("YOLO model loaded successfully")
         return model
     except Exception as e:
         print(f"Failed to load YOLO model: {str(e)}")
         sys.exit(1)
 
+@njit(cache=True)
+def filter_dets(arr, coi_mask, thr):
+    """Split (N, 6) x1,y1,x2,y2,conf,cls rows into boxes, confidences and class ids of interest above thr"""
+    boxes = np.empty((arr.shape[0], 4), dtype=np.float32)
+    confs = np.empty(arr.shape[0], dtype=np.float32)
+    class_ids = np.empty(arr.shape[0], dtype=np.int64)
+    n = 0
+    for i in range(arr.shape[0]):
+        c = int(arr[i, 5])
+        if arr[i, 4] > thr and c < coi_mask.shape[0] and coi_mask[c]:
+            boxes[n] = arr[i, :4]
+            confs[n] = arr[i, 4]
+            class_ids[n] = c
+            n += 1
+    return boxes[:n], confs[:n], class_ids[:n]
+
 def yolo_detection_thread(model):
     """Thread to run YOLO detection on frames"""
     global last_yolo_process_time
@@ -186,60 +237,70 @@ def yolo_detection_thread(model):
             
             # Only process frames at the specified interval
             if current_time - last_yolo_process_time >= YOLO_PROCESSING_INTERVAL:
-                if not frame_queue.empty():
+                # Drain up to YOLO_BATCH_SIZE queued frames into one batch
+                batch = []
+                while len(batch) < YOLO_BATCH_SIZE and not frame_queue.empty():
                     frame_data = frame_queue.get()
-                    if frame_data is None:
-                        continue
-                    
-                    frame, timestamp = frame_data
-                    results = model(frame, conf=CONFIDENCE_THRESHOLD)
-                    
-                    detections = []
-                    for r in results:
-                        boxes = r.boxes
-                        for box in boxes:
-                            x1, y1, x2, y2 = box.xyxy[0]
-                            conf = float(box.conf[0])
-                            cls = int(box.cls[0])
-                            
-                            # If the class is in our list of interest, and confidence exceeds threshold
-                            if cls in CLASSES_OF_INTEREST and conf > CONFIDENCE_THRESHOLD:
-                                class_name = model.names[cls]
-                                detection = {
-                                    "box": [float(x1), float(y1), float(x2), float(y2)],
-                                    "class": class_name,
-                                    "class_id": cls,
-                                    "confidence": conf
-                                }
-                                detections.append(detection)
+                    if frame_data is not None:
+                        batch.append(frame_data)
+                
+                if batch:
+                    # Ultralytics stacks the list into a single NCHW forward pass
+                    results = model([frame for frame, _ in batch], conf=CONFIDENCE_THRESHOLD)
                     
-                    # Debug: Print detection results
-                    if DEBUG_MODE and detections:
-                        print(f"YOLO thread: Found {len(detections)} objects with confidence > {CONFIDENCE_THRESHOLD}")
-                        for d in detections[:3]:  # Print first 3 detections
-                            print(f"  {d['class']} (conf: {d['confidence']:.2f})")
-                        if len(detections) > 3:
-                            print(f"  ... and {len(detections) - 3} more")
+                    if DEBUG_MODE and torch.cuda.is_available():
+                        print(f"YOLO thread: batch of {len(batch)}, peak VRAM {torch.cuda.max_memory_allocated() / 2**20:.0f} MB")
                     
-                    # Put results in the detection queue
-                    detection_result = {
-                        "timestamp": timestamp,
-                        "detections": detections,
-                        "source": "edge"
-                    }
+                    # Copy the whole batch's boxes to the host at once, as (N, 6) x1,y1,x2,y2,conf,cls;
+                    # FP16 engines return half-precision boxes, which filter_dets cannot compile for
+                    data = torch.cat([r.boxes.data for r in results]).float()
+                    if data.is_cuda:
+                        # Pinned async copy, then a single sync for the batch
+                        data = data.to('cpu', non_blocking=True)
+                        torch.cuda.current_stream().synchronize()
+                    counts = [len(r.boxes) for r in results]
+                    frame_arrs = np.split(data.numpy(), np.cumsum(counts)[:-1])
                     
-                    # Only add to queue if not full
-                    if not detection_queue.full():
-                        detection_queue.put((frame, detection_result))
+                    for (frame, timestamp), arr in zip(batch, frame_arrs):
+                        boxes, confs, class_ids = filter_dets(arr, COI_MASK, CONFIDENCE_THRESHOLD)
+                        
+                        detections = [
+                            {
+                                "box": box,
+                                "class": model.names[cls],
+                                "class_id": cls,
+                                "confidence": conf
+                            }
+                            for box, conf, cls in zip(boxes.tolist(), confs.tolist(), class_ids.tolist())
+                        ]
+                        
+                        # Debug: Print detection results
+                        if DEBUG_MODE and detections:
+                            print(f"YOLO thread: Found {len(detections)} objects with confidence > {CONFIDENCE_THRESHOLD}")
+                            for d in detections[:3]:  # Print first 3 detections
+                                print(f"  {d['class']} (conf: {d['confidence']:.2f})")
+                            if len(detections) > 3:
+                                print(f"  ... and {len(detections) - 3} more")
+                        
+                        # Put results in the detection queue
+                        detection_result = {
+                            "timestamp": timestamp,
+                            "detections": detections,
+                            "source": "edge"
+                        }
+                        
+                        # Only add to queue if not full
+                        if not detection_queue.full():
+                            detection_queue.put((frame, detection_result))
+                        
+                        # Print detection summary
+                        if detections:
+                            print(f"Detected {len(detections)} objects: " + 
+                                  ", ".join([f"{d['class']} ({d['confidence']:.2f})" for d in detections[:3]]) +
+                                  ("..." if len(detections) > 3 else ""))
                     
                     # Update last process time
                     last_yolo_process_time = current_time
-                    
-                    # Print detection summary
-                    if detections:
-                        print(f"Detected {len(detections)} objects: " + 
-                              ", ".join([f"{d['class']} ({d['confidence']:.2f})" for d in detections[:3]]) +
-                              ("..." if len(detections) > 3 else ""))
             
             # Brief pause to prevent CPU overuse
             time.sleep(0.01)
@@ -2,26 +2,151 @@ import os
 import json
 import uuid
 import time
+import gzip
+import io
+import av
+import cv2
 import boto3
-import base64
+import orjson
+import hashlib
+import functools
+import threading
+from botocore.config import Config
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-s3_client = boto3.client('s3')
-bedrock_runtime = boto3.client('bedrock-runtime')
-dynamodb = boto3.resource('dynamodb')
-iot_client = boto3.client('iot-data')
+# Cap on concurrent S3/IoT calls; client connection pools are sized to match
+IO_CONCURRENCY = 32
+# Keep-alive connections and adaptive retries (client-side backoff on throttling)
+client_config = Config(
+    max_pool_connections=IO_CONCURRENCY,
+    tcp_keepalive=True,
+    retries={'mode': 'adaptive', 'max_attempts': 3}
+)
+
+# One session for every client, created once per container and reused by warm invocations
+session = boto3.Session()
+s3_client = session.client('s3', config=client_config)
+bedrock_runtime = session.client('bedrock-runtime', config=client_config)
+dynamodb = session.resource('dynamodb', config=client_config)
+iot_client = session.client('iot-data', config=client_config)
+kvs_client = session.client('kinesisvideo', config=client_config)
+# Runs a frame's independent S3 upload and IoT publish side by side
+io_executor = ThreadPoolExecutor(max_workers=IO_CONCURRENCY)
 
 # Get environment variables
 BUCKET_NAME = os.environ['FRAME_BUCKET']
 DETECTION_TABLE = os.environ['DETECTION_TABLE']
 BEDROCK_MODEL_ID = os.environ['BEDROCK_MODEL_ID']
 IOT_TOPIC_PREFIX = os.environ['IOT_TOPIC_PREFIX']
+# Bedrock quota for this function (0 disables shaping), split across its expected concurrent executions
+BEDROCK_RPM = float(os.environ.get('BEDROCK_RPM', '0'))
+BEDROCK_TPM = float(os.environ.get('BEDROCK_TPM', '0'))
+BEDROCK_CONCURRENCY = int(os.environ.get('BEDROCK_CONCURRENCY', '1'))
+# JPEG quality of extracted frames, which are uploaded to S3 and sent to Bedrock as-is
+FRAME_JPEG_QUALITY = 75
+# gzip level for stored detection results; 6 compresses small JSON nearly as well as 9 at a fraction of the CPU
+DETECTION_GZIP_LEVEL = 6
+# Response cache for identical frames: off, read-write, or replay (cached responses only, no Bedrock calls)
+CACHE_POLICY = os.environ.get('CACHE_POLICY', 'read-write')
+# Fragments of a batched event processed concurrently (Bedrock calls are I/O-bound)
+MAX_PARALLEL_FRAGMENTS = int(os.environ.get('MAX_PARALLEL_FRAGMENTS', '8'))
+# Optional persistent MQTT connection for edge commands (AWSIoTPythonSDK); iot-data over HTTPS is used when unset
+IOT_MQTT_ENDPOINT = os.environ.get('IOT_MQTT_ENDPOINT')
+# Suffixed per container: IoT Core drops a session when another connects with the same client ID
+IOT_MQTT_CLIENT_ID = f"{os.environ.get('IOT_MQTT_CLIENT_ID', 'lambda-frame-processor')}-{uuid.uuid4().hex[:8]}"
+# Short timeouts, and no reconnect attempts for a while after a failed connect, so stop commands reach iot-data quickly
+IOT_MQTT_TIMEOUT = 2
+IOT_MQTT_RETRY_COOLDOWN = 30
+IOT_CERT_PATH = os.environ.get('IOT_CERT_PATH')
+IOT_PRIVATE_KEY_PATH = os.environ.get('IOT_PRIVATE_KEY_PATH')
+IOT_ROOT_CA_PATH = os.environ.get('IOT_ROOT_CA_PATH')
+
+# Static detection instructions, sent as the system prompt so only the image changes between frames
+DETECTION_PROMPT = "Analyze this image from an urban street scene. Identify all humans, vehicles (cars, bikes, etc.), animals, and other potential obstacles. For each object, provide its location in the image (top, bottom, left, right) and confidence score. Format the response as JSON only."
+
+# Bump when DETECTION_PROMPT or the response handling changes so older cached responses are not reused
+PROMPT_VERSION = '2'
+# Cached responses live in the frame bucket (expired by its lifecycle rule) and, per warm container, in memory
+RESPONSE_CACHE_PREFIX = 'cache/detections'
+RESPONSE_CACHE_SIZE = 256
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
+
+class TokenBucket:
+    """Paces Bedrock calls below a requests-per-minute and tokens-per-minute budget"""
+    
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        # Refill rates per second; 0 leaves that dimension unlimited
+        self.request_rate = requests_per_minute / 60
+        self.token_rate = tokens_per_minute / 60
+        self.request_capacity = max(requests_per_minute, 1)
+        self.token_capacity = tokens_per_minute
+        self.requests = self.request_capacity
+        self.tokens = self.token_capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self, estimated_tokens):
+        """Block until one request and estimated_tokens tokens are available, then take them"""
+        estimated_tokens = min(estimated_tokens, self.token_capacity)
+        
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.last_refill
+                self.last_refill = now
+                self.requests = min(self.request_capacity, self.requests + elapsed * self.request_rate)
+                self.tokens = min(self.token_capacity, self.tokens + elapsed * self.token_rate)
+                
+                wait = 0
+                if self.request_rate and self.requests < 1:
+                    wait = (1 - self.requests) / self.request_rate
+                if self.token_rate and self.tokens < estimated_tokens:
+                    wait = max(wait, (estimated_tokens - self.tokens) / self.token_rate)
+                
+                if wait == 0:
+                    self.requests -= 1
+                    self.tokens -= estimated_tokens
+                    return
+            
+            time.sleep(wait)
+
+# Shared by all fragments handled by this container
+if BEDROCK_RPM or BEDROCK_TPM:
+    bedrock_bucket = TokenBucket(BEDROCK_RPM / BEDROCK_CONCURRENCY, BEDROCK_TPM / BEDROCK_CONCURRENCY)
+else:
+    bedrock_bucket = None
+
+# Bedrock downscales images to about 1.15 megapixels, roughly 1600 input tokens
+BEDROCK_IMAGE_TOKENS = 1600
+BEDROCK_MAX_TOKENS = 1000
+
+# Cleared when Bedrock rejects performanceConfig, for models without latency-optimized inference
+latency_optimized = True
+
+# GET_MEDIA clients per stream, so endpoint discovery runs once per warm container
+media_clients = {}
+media_clients_lock = threading.Lock()
 
-def extract_frame(kvs_client, stream_name, fragment_number):
+def get_media_client(stream_name):
+    """Return a kinesis-video-media client bound to the stream's GET_MEDIA endpoint"""
+    with media_clients_lock:
+        if stream_name not in media_clients:
+            data_endpoint_response = kvs_client.get_data_endpoint(
+                StreamName=stream_name,
+                APIName='GET_MEDIA'
+            )
+            endpoint = data_endpoint_response['DataEndpoint']
+            media_clients[stream_name] = session.client('kinesis-video-media', endpoint_url=endpoint, config=client_config)
+        return media_clients[stream_name]
+
+def extract_frame(media_client, stream_name, fragment_number):
     """Extract a frame from Kinesis Video Stream"""
     try:
         # Get the media for the specific fragment
-        response = kvs_client.get_media(
+        response = media_client.get_media(
             StreamName=stream_name,
             StartSelector={
                 'StartSelectorType': 'FRAGMENT_NUMBER',
@@ -29,66 +154,85 @@ def extract_frame(kvs_client, stream_name, fragment_number):
             }
         )
         
-        # For simplicity in POC, we're assuming we can extract a frame from the fragment
-        # In a production system, we would use a proper video frame extractor
         payload = response['Payload'].read()
         
-        # For POC purposes, we're just taking a section of the payload as our "frame"
-        # In production, you would use OpenCV or similar to properly extract the frame
-        frame_data = payload[:1024*1024]  # Example - first MB of data
+        # Decode the fragment's keyframe in memory with PyAV, skipping non-key frames
+        with av.open(io.BytesIO(payload)) as container:
+            stream = container.streams.video[0]
+            stream.codec_context.skip_frame = 'NONKEY'
+            frame = next(container.decode(stream), None)
+            if frame is None:
+                print(f"No frame decoded from fragment {fragment_number}")
+                return None
+            image = frame.to_ndarray(format='bgr24')
         
-        return frame_data
+        # Re-encode as a compact JPEG; the same bytes are stored and sent to Bedrock
+        ret, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, FRAME_JPEG_QUALITY])
+        return jpeg.tobytes() if ret else None
     except Exception as e:
         print(f"Error extracting frame: {str(e)}")
         return None
 
+def converse_bedrock(request):
+    """Call the Bedrock Converse API, using latency-optimized inference where the model supports it"""
+    global latency_optimized
+    
+    if latency_optimized:
+        try:
+            return bedrock_runtime.converse(**request, performanceConfig={'latency': 'optimized'})
+        except bedrock_runtime.exceptions.ValidationException as e:
+            # Only an unsupported performanceConfig is fixed by retrying without it
+            message = str(e).lower()
+            if 'performanceconfig' not in message and 'latency' not in message:
+                raise
+            print(f"Latency-optimized inference unavailable, using standard: {str(e)}")
+            latency_optimized = False
+    
+    return bedrock_runtime.converse(**request)
+
 def detect_objects_with_bedrock(frame_data, timestamp):
     """Detect objects in the frame using Bedrock"""
     try:
-        # For the POC, we'll use base64 encoded image with Claude model
+        # For the POC, we'll send the image to a Claude model
         # In production, you might use a specialized computer vision model
         
-        base64_image = base64.b64encode(frame_data).decode('utf-8')
-        
-        payload = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 1000,
+        # The Converse API takes the raw image bytes; boto3 handles the encoding
+        request = {
+            "modelId": BEDROCK_MODEL_ID,
+            "system": [{"text": DETECTION_PROMPT}],
             "messages": [
                 {
                     "role": "user",
                     "content": [
                         {
-                            "type": "text", 
-                            "text": "Analyze this image from an urban street scene. Identify all humans, vehicles (cars, bikes, etc.), animals, and other potential obstacles. For each object, provide its location in the image (top, bottom, left, right) and confidence score. Format the response as JSON only."
-                        },
-                        {
-                            "type": "image", 
-                            "source": {
-                                "type": "base64", 
-                                "media_type": "image/jpeg", 
-                                "data": base64_image
+                            "image": {
+                                "format": "jpeg",
+                                "source": {"bytes": frame_data}
                             }
                         }
                     ]
                 }
-            ]
+            ],
+            "inferenceConfig": {"maxTokens": BEDROCK_MAX_TOKENS}
         }
         
-        response = bedrock_runtime.invoke_model(
-            modelId=BEDROCK_MODEL_ID,
-            body=json.dumps(payload)
-        )
+        # Quotas count the prompt, the image and the requested output tokens
+        if bedrock_bucket:
+            bedrock_bucket.acquire(len(DETECTION_PROMPT) // 4 + BEDROCK_IMAGE_TOKENS + BEDROCK_MAX_TOKENS)
         
-        response_body = json.loads(response['body'].read())
+        response = converse_bedrock(request)
+        
+        usage = response.get('usage', {})
+        print(f"Bedrock usage: input={usage.get('inputTokens')}, output={usage.get('outputTokens')}")
         
         # Extract the JSON content from Claude's response
         # This is a simplified approach - production code would need more robust parsing
-        content = response_body.get('content', [{}])[0].get('text', '{}')
+        content = response['output']['message']['content'][0].get('text', '{}')
         
         # Try to parse the JSON from Claude's response
         try:
-            detection_data = json.loads(content)
-        except json.JSONDecodeError:
+            detection_data = orjson.loads(content)
+        except orjson.JSONDecodeError:
             # If Claude didn't return valid JSON, create a basic structure
             detection_data = {"objects": [], "error": "Failed to parse model output"}
         
@@ -107,8 +251,74 @@ def detect_objects_with_bedrock(frame_data, timestamp):
             "source": "cloud"
         }
 
+def response_cache_key(frame_data):
+    """Return the S3 key caching the detection for this frame, model and prompt version"""
+    frame_hash = hashlib.sha256(frame_data).hexdigest()
+    return f"{RESPONSE_CACHE_PREFIX}/{BEDROCK_MODEL_ID}/{PROMPT_VERSION}/{frame_hash}.json"
+
+def remember_detection(cache_key, detection_data):
+    """Keep a detection in the in-memory LRU cache"""
+    with response_cache_lock:
+        response_cache[cache_key] = detection_data
+        response_cache.move_to_end(cache_key)
+        if len(response_cache) > RESPONSE_CACHE_SIZE:
+            response_cache.popitem(last=False)
+
+def get_cached_detection(cache_key):
+    """Look up a cached detection in memory, then in S3"""
+    with response_cache_lock:
+        if cache_key in response_cache:
+            response_cache.move_to_end(cache_key)
+            return response_cache[cache_key]
+    
+    try:
+        response = s3_client.get_object(Bucket=BUCKET_NAME, Key=cache_key)
+        detection_data = orjson.loads(response['Body'].read())
+    except s3_client.exceptions.ClientError:
+        return None
+    
+    remember_detection(cache_key, detection_data)
+    return detection_data
+
+def put_cached_detection(cache_key, detection_data):
+    """Cache a detection in memory and in S3"""
+    remember_detection(cache_key, detection_data)
+    try:
+        s3_client.put_object(
+            Bucket=BUCKET_NAME,
+            Key=cache_key,
+            Body=orjson.dumps(detection_data),
+            ContentType='application/json'
+        )
+    except Exception as e:
+        print(f"Error caching detection: {str(e)}")
+
+def detect_objects(frame_data, timestamp):
+    """Detect objects in the frame, reusing the cached response for identical frames"""
+    if CACHE_POLICY == 'off':
+        return detect_objects_with_bedrock(frame_data, timestamp)
+    
+    cache_key = response_cache_key(frame_data)
+    cached = get_cached_detection(cache_key)
+    if cached is not None:
+        print(f"Using cached detection: {cache_key}")
+        return dict(cached, timestamp=timestamp)
+    
+    if CACHE_POLICY == 'replay':
+        return {
+            "objects": [],
+            "error": "No cached response (replay mode)",
+            "timestamp": timestamp,
+            "source": "cloud"
+        }
+    
+    detection_data = detect_objects_with_bedrock(frame_data, timestamp)
+    if 'error' not in detection_data:
+        put_cached_detection(cache_key, detection_data)
+    return detection_data
+
 def store_frame_and_detection(frame_data, detection_data, timestamp):
-    """Store frame in S3 and detection results in DynamoDB"""
+    """Store frame in S3 and return the DynamoDB item for its detection results"""
     try:
         # Generate unique ID for this frame
         frame_id = str(uuid.uuid4())
@@ -124,25 +334,111 @@ def store_frame_and_detection(frame_data, detection_data, timestamp):
             ContentType='image/jpeg'
         )
         
-        # Store detection results in DynamoDB
-        table = dynamodb.Table(DETECTION_TABLE)
-        
+        # Detection results are stored gzip-compressed to stay well under the 400 KB item limit
         item = {
             'frameId': frame_id,
             'timestamp': int(timestamp),
             'frameS3Path': frame_key,
-            'detectionResults': detection_data,
+            'detectionResultsGz': gzip.compress(orjson.dumps(detection_data), compresslevel=DETECTION_GZIP_LEVEL),
             'ttl': int(timestamp) + (7 * 24 * 60 * 60)  # 7 days TTL
         }
         
-        table.put_item(Item=item)
-        
-        return frame_id
+        return item
     
     except Exception as e:
         print(f"Error storing frame and detection: {str(e)}")
         return None
 
+def write_detection_items(items):
+    """Write detection items to DynamoDB, 25 per BatchWriteItem request"""
+    try:
+        table = dynamodb.Table(DETECTION_TABLE)
+        # batch_writer flushes every 25 items and resends unprocessed items
+        with table.batch_writer() as batch:
+            for item in items:
+                batch.put_item(Item=item)
+    except Exception as e:
+        # Surface the failure so the invocation errors instead of silently losing detections
+        print(f"Error writing detections: {str(e)}")
+        raise
+
+# Connected on first use and kept across warm invocations
+mqtt_client = None
+mqtt_client_lock = threading.Lock()
+# Monotonic time before which no new connection is attempted
+mqtt_retry_after = 0.0
+
+def get_mqtt_client():
+    """Return the persistent MQTT client, connecting it if needed; None when MQTT is not configured or cooling down"""
+    global mqtt_client, mqtt_retry_after
+    if not all([IOT_MQTT_ENDPOINT, IOT_CERT_PATH, IOT_PRIVATE_KEY_PATH, IOT_ROOT_CA_PATH]):
+        return None
+    
+    with mqtt_client_lock:
+        if mqtt_client is None:
+            if time.monotonic() < mqtt_retry_after:
+                return None
+            from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+            
+            client = AWSIoTMQTTClient(IOT_MQTT_CLIENT_ID)
+            client.configureEndpoint(IOT_MQTT_ENDPOINT, 8883)
+            client.configureCredentials(IOT_ROOT_CA_PATH, IOT_PRIVATE_KEY_PATH, IOT_CERT_PATH)
+            client.configureAutoReconnectBackoffTime(1, 32, 20)
+            # No offline queueing: a publish on a dead connection must fail so iot-data can deliver it
+            client.configureOfflinePublishQueueing(0)
+            client.configureConnectDisconnectTimeout(IOT_MQTT_TIMEOUT)
+            client.configureMQTTOperationTimeout(IOT_MQTT_TIMEOUT)
+            try:
+                client.connect()
+            except Exception:
+                mqtt_retry_after = time.monotonic() + IOT_MQTT_RETRY_COOLDOWN
+                raise
+            print("Connected to AWS IoT Core over MQTT")
+            mqtt_client = client
+        return mqtt_client
+
+def publish_command(topic, payload):
+    """Publish a command over the persistent MQTT connection, falling back to iot-data"""
+    global mqtt_client
+    # A connection left stale by a frozen container is replaced once before falling back
+    for attempt in range(2):
+        try:
+            client = get_mqtt_client()
+            if client is None:
+                break
+            # QoS 1 so publish() only succeeds once the broker has acknowledged the command
+            if client.publish(topic, payload, 1):
+                return
+            print("MQTT publish was not acknowledged")
+        except Exception as e:
+            print(f"MQTT publish failed: {str(e)}")
+        with mqtt_client_lock:
+            stale_client, mqtt_client = mqtt_client, None
+        if stale_client is not None:
+            try:
+                stale_client.disconnect()
+            except Exception:
+                pass
+    
+    iot_client.publish(
+        topic=topic,
+        payload=payload
+    )
+
+@functools.lru_cache(maxsize=256)
+def topic_for(device_id):
+    """Return the command topic for an edge device"""
+    return f"{IOT_TOPIC_PREFIX}/commands/{device_id}"
+
+# Object types that stop the vehicle when detected above CRITICAL_CONFIDENCE
+CRITICAL_OBJECTS = frozenset({'human', 'person', 'pedestrian', 'animal', 'dog', 'cat'})
+CRITICAL_CONFIDENCE = 0.7
+# Critical objects named in a stop command's reason; the scan stops once this many are found
+CRITICAL_REASON_LIMIT = 3
+
+# Fixed head of every stop command, so only the reason and timestamp are serialized per publish
+STOP_COMMAND_PREFIX = b'{"command":"stop","reason":'
+
 def send_command_to_edge(detection_data, device_id):
     """Send command to edge device if necessary"""
     # Simple logic: if humans or animals detected with high confidence, send stop command
@@ -150,30 +446,28 @@ def send_command_to_edge(detection_data, device_id):
     
     try:
         # Check for objects of interest
-        should_stop = False
         critical_objects = []
         
-        for obj in detection_data.get('objects', []):
-            object_type = obj.get('type', '').lower()
-            confidence = obj.get('confidence', 0)
-            
-            if (object_type in ['human', 'person', 'pedestrian', 'animal', 'dog', 'cat']) and confidence > 0.7:
-                should_stop = True
-                critical_objects.append(object_type)
-        
-        if should_stop:
-            command = {
-                'command': 'stop',
-                'reason': f"Critical objects detected: {', '.join(critical_objects)}",
-                'timestamp': int(time.time())
-            }
+        for obj in detection_data.get('objects', ()):
+            if obj.get('confidence', 0) > CRITICAL_CONFIDENCE:
+                object_type = obj.get('type', '').lower()
+                if object_type in CRITICAL_OBJECTS:
+                    critical_objects.append(object_type)
+                    if len(critical_objects) == CRITICAL_REASON_LIMIT:
+                        break
+        
+        if critical_objects:
+            reason = f"Critical objects detected: {', '.join(critical_objects)}"
+            command = b''.join([
+                STOP_COMMAND_PREFIX,
+                orjson.dumps(reason),
+                b',"timestamp":',
+                str(int(time.time())).encode(),
+                b'}'
+            ])
             
             # Publish to IoT topic
-            topic = f"{IOT_TOPIC_PREFIX}/commands/{device_id}"
-            iot_client.publish(
-                topic=topic,
-                payload=json.dumps(command)
-            )
+            publish_command(topic_for(device_id), command)
             
             return True
     
@@ -182,62 +476,100 @@ def send_command_to_edge(detection_data, device_id):
     
     return False
 
+def process_fragment(stream_name, fragment_number, device_id):
+    """Extract, detect, store and act on a single fragment"""
+    # Errors are reported per fragment so one bad fragment does not lose the rest of the batch
+    try:
+        # Current timestamp
+        timestamp = int(time.time())
+        
+        # Extract frame
+        frame_data = extract_frame(get_media_client(stream_name), stream_name, fragment_number)
+        if not frame_data:
+            return {
+                'fragmentNumber': fragment_number,
+                'error': 'Failed to extract frame'
+            }, None
+        
+        # Detect objects
+        detection_data = detect_objects(frame_data, timestamp)
+        
+        # Store frame and send command to edge if necessary, overlapping both requests;
+        # the detection item is written with the rest of the batch
+        store_future = io_executor.submit(store_frame_and_detection, frame_data, detection_data, timestamp)
+        command_future = io_executor.submit(send_command_to_edge, detection_data, device_id)
+        item = store_future.result()
+        command_sent = command_future.result()
+        
+        return {
+            'fragmentNumber': fragment_number,
+            'frameId': item['frameId'] if item else None,
+            'commandSent': command_sent,
+            'objectsDetected': len(detection_data.get('objects', []))
+        }, item
+    except Exception as e:
+        print(f"Error processing fragment {fragment_number}: {str(e)}")
+        return {
+            'fragmentNumber': fragment_number,
+            'error': str(e)
+        }, None
+
 def lambda_handler(event, context):
     """Main Lambda handler function"""
     # In a real implementation, this would be triggered by Kinesis Data Stream
     # For POC purposes, we assume the event contains:
     # - streamName: The Kinesis Video Stream name
+    # - fragments: List of {fragmentNumber, deviceId} to process in one invocation
+    # or, for a single fragment:
     # - fragmentNumber: The fragment to process
     # - deviceId: The edge device ID
     
     try:
         stream_name = event.get('streamName')
-        fragment_number = event.get('fragmentNumber')
-        device_id = event.get('deviceId')
+        batched = 'fragments' in event
+        if batched:
+            fragments = event['fragments'] or []
+        else:
+            fragments = [{
+                'fragmentNumber': event.get('fragmentNumber'),
+                'deviceId': event.get('deviceId')
+            }]
         
-        if not all([stream_name, fragment_number, device_id]):
+        if not stream_name or not fragments or not all(
+                fragment.get('fragmentNumber') and fragment.get('deviceId') for fragment in fragments):
             return {
                 'statusCode': 400,
                 'body': json.dumps('Missing required parameters')
             }
         
-        # Get KVS client
-        kvs_client = boto3.client('kinesisvideo')
-        data_endpoint_response = kvs_client.get_data_endpoint(
-            StreamName=stream_name,
-            APIName='GET_MEDIA'
-        )
+        # Overlap the per-frame Bedrock, S3, DynamoDB and IoT calls
+        with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_FRAGMENTS, len(fragments))) as executor:
+            processed = list(executor.map(
+                lambda fragment: process_fragment(stream_name, fragment['fragmentNumber'], fragment['deviceId']),
+                fragments
+            ))
         
-        endpoint = data_endpoint_response['DataEndpoint']
-        kvs_client = boto3.client('kinesisvideo', endpoint_url=endpoint)
+        results = [result for result, _ in processed]
+        items = [item for _, item in processed if item]
+        if items:
+            write_detection_items(items)
         
-        # Current timestamp
-        timestamp = int(time.time())
+        if batched:
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'results': results})
+            }
         
-        # Extract frame
-        frame_data = extract_frame(kvs_client, stream_name, fragment_number)
-        if not frame_data:
+        result = results[0]
+        if 'error' in result:
             return {
                 'statusCode': 500,
-                'body': json.dumps('Failed to extract frame')
+                'body': json.dumps(result['error'])
             }
-        
-        # Detect objects
-        detection_data = detect_objects_with_bedrock(frame_data, timestamp)
-        
-        # Store frame and detection results
-        frame_id = store_frame_and_detection(frame_data, detection_data, timestamp)
-        
-        # Send command to edge if necessary
-        command_sent = send_command_to_edge(detection_data, device_id)
-        
+        del result['fragmentNumber']
         return {
             'statusCode': 200,
-            'body': json.dumps({
-                'frameId': frame_id,
-                'commandSent': command_sent,
-                'objectsDetected': len(detection_data.get('objects', []))
-            })
+            'body': json.dumps(result)
         }
     
     except Exception as e:
@@ -25,12 +25,13 @@ def message_callback(client, userdata, message):
         print("Payload:")
         print(json.dumps(payload, indent=2))
         
-        # Print detection summary
-        if "detections" in payload:
-            detections = payload["detections"]
-            print(f"\nDetected {len(detections)} objects:")
-            for i, det in enumerate(detections):
-                print(f"  {i+1}. {det.get('class', 'unknown')} - Confidence: {det.get('confidence', 0):.2f}")
+        # Print detection summary (edge devices may batch several results per message)
+        for result in payload.get("batch", [payload]):
+            if "detections" in result:
+                detections = result["detections"]
+                print(f"\nDetected {len(detections)} objects:")
+                for i, det in enumerate(detections):
+                    print(f"  {i+1}. {det.get('class', 'unknown')} - Confidence: {det.get('confidence', 0):.2f}")
     except Exception as e:
         print(f"Error processing message: {e}")
         print(f"Raw payload: {message.payload}")